@@ -1,23 +1,50 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import Substr
+from .cache import invalidate_history_on_commit
 from .models import AIChat, AIMessage
 
 
 @admin.register(AIChat)
 class AIChatAdmin(admin.ModelAdmin):
     list_display = ['title', 'user', 'related_chat', 'created_at', 'updated_at']
+    list_select_related = ['user', 'related_chat']
     list_filter = ['created_at', 'updated_at']
     search_fields = ['title', 'user__username']
     readonly_fields = ['created_at', 'updated_at']
 
 
+class AIMessageChangeList(ChangeList):
+    def get_queryset(self, request, exclude_parameters=None):
+        """Cut the preview in the database so the list never loads full message bodies"""
+        return super().get_queryset(request, exclude_parameters).annotate(
+            _preview=Substr('content', 1, 51)
+        ).defer('content')
+
+
 @admin.register(AIMessage)
 class AIMessageAdmin(admin.ModelAdmin):
     list_display = ['ai_chat', 'role', 'content_preview', 'timestamp', 'total_tokens']
+    list_select_related = ['ai_chat', 'ai_chat__user']
     list_filter = ['role', 'timestamp']
     search_fields = ['content', 'ai_chat__title']
     readonly_fields = ['timestamp']
     
+    def get_changelist(self, request, **kwargs):
+        return AIMessageChangeList
+    
+    def delete_queryset(self, request, queryset):
+        """Delete the selected messages, then uncount them and drop the cached history once per chat"""
+        with transaction.atomic():
+            counts = list(queryset.order_by().values_list('ai_chat').annotate(count=Count('pk')))
+            super().delete_queryset(request, queryset)
+            for ai_chat_id, count in counts:
+                AIChat.objects.filter(pk=ai_chat_id).update(message_count=F('message_count') - count)
+                invalidate_history_on_commit(ai_chat_id)
+    
     def content_preview(self, obj):
         """Show first 50 characters of content"""
-        return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
+        return obj._preview[:50] + '...' if len(obj._preview) > 50 else obj._preview
     content_preview.short_description = 'Content'
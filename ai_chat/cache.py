@@ -0,0 +1,114 @@
+"""
+Cache keys and timeouts shared by the AI chat consumer, views and signals.
+"""
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .clients import REPLY_TIMEOUT
+
+HISTORY_CACHE_TIMEOUT = 3600
+OWNER_CACHE_TIMEOUT = 3600
+RESPONSE_CACHE_TIMEOUT = 3600
+# Upper bound on one turn: a reply is abandoned after REPLY_TIMEOUT, plus up to one read
+# timeout for the chunk that crosses it and time to save the turn. It also lets the lock
+# of a crashed worker expire. Each turn holds its own token, so a turn that still outlives
+# the lock cannot release the lock of the next one.
+# The lock is only shared between workers through a shared cache (REDIS_URL)
+TURN_LOCK_TIMEOUT = REPLY_TIMEOUT + 120
+
+
+def history_version_key(ai_chat_id):
+    """Key for the version the cached history of an AI chat is stored under"""
+    return f'aichat:msgs:version:{ai_chat_id}'
+
+
+def history_cache_key(ai_chat_id, version):
+    """Key for the cached system prompt + prior turns of an AI chat"""
+    return f'aichat:msgs:{ai_chat_id}:{version}'
+
+
+def history_version(ai_chat_id):
+    """
+    Return the version the cached history of an AI chat is stored under.
+    Invalidating deletes the version, so a turn that read the history before a change
+    writes its extended copy under a key that is no longer read.
+    """
+    key = history_version_key(ai_chat_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(key, version, timeout=HISTORY_CACHE_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+async def ahistory_version(ai_chat_id):
+    """Async version of history_version"""
+    key = history_version_key(ai_chat_id)
+    version = await cache.aget(key)
+    if version is None:
+        version = uuid4().hex
+        if not await cache.aadd(key, version, timeout=HISTORY_CACHE_TIMEOUT):
+            version = await cache.aget(key, version)
+    return version
+
+
+def invalidate_history_on_commit(ai_chat_id):
+    """Drop the cached history of an AI chat once the current transaction commits"""
+    key = history_version_key(ai_chat_id)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def owner_cache_key(ai_chat_id):
+    """Key for the cached owner and related chat of an AI chat"""
+    return f'aichat:owner:{ai_chat_id}'
+
+
+def turn_lock_key(ai_chat_id):
+    """Key held while a reply is being generated for an AI chat"""
+    return f'aichat:turn:{ai_chat_id}'
+
+
+def acquire_turn_lock(ai_chat_id):
+    """Take the turn lock of an AI chat; returns the token to release it with, or None if it is held"""
+    token = uuid4().hex
+    if cache.add(turn_lock_key(ai_chat_id), token, timeout=TURN_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+async def aacquire_turn_lock(ai_chat_id):
+    """Async version of acquire_turn_lock"""
+    token = uuid4().hex
+    if await cache.aadd(turn_lock_key(ai_chat_id), token, timeout=TURN_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def release_turn_lock(ai_chat_id, token):
+    """Release the turn lock of an AI chat if it is still held with token"""
+    key = turn_lock_key(ai_chat_id)
+    if cache.get(key) == token:
+        cache.delete(key)
+
+
+async def arelease_turn_lock(ai_chat_id, token):
+    """Async version of release_turn_lock"""
+    key = turn_lock_key(ai_chat_id)
+    if await cache.aget(key) == token:
+        await cache.adelete(key)
+
+
+def messages_response_cache_key(ai_chat_id, last_message_id, message_count):
+    """
+    Key for the serialized messages of an AI chat.
+    It changes whenever a message is added or removed, so old entries simply expire.
+    """
+    return f'aichat:{ai_chat_id}:msgs:{last_message_id}:{message_count}'
+
+
+def related_context_cache_key(chat_id, last_message_id, limit):
+    """Key for the formatted latest messages of a related chat, rotated by its newest message"""
+    return f'aichat:related:{chat_id}:{last_message_id}:{limit}'
@@ -0,0 +1,73 @@
+"""
+Shared OpenAI clients for the AI chat consumer and views.
+"""
+import httpx
+import orjson
+from django.conf import settings
+from openai import AsyncOpenAI, AsyncStream, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+from openai.types.responses import Response, ResponseStreamEvent
+
+
+_openai_client = None
+_async_openai_client = None
+
+# Over HTTP/2 concurrent requests are multiplexed as streams on a few connections,
+# so only a handful need to be kept alive
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=8, max_connections=64, keepalive_expiry=30)
+
+# Requests wait at most this long to connect and for each chunk of the reply,
+# not for the whole reply
+OPENAI_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# A streamed reply still coming in after this many seconds is abandoned
+REPLY_TIMEOUT = 180
+
+
+class IncompleteResponseError(Exception):
+    """A streamed reply failed or stopped before it was complete, so it must not be saved"""
+
+
+def get_openai_client():
+    """
+    Return the shared OpenAI client, creating it on first use.
+    Requests reuse its connection pool instead of opening a new TLS connection each time.
+    """
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = OpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            timeout=OPENAI_TIMEOUT,
+            http_client=DefaultHttpxClient(http2=True, limits=HTTP_LIMITS)
+        )
+    return _openai_client
+
+
+def get_async_openai_client():
+    """
+    Return the shared AsyncOpenAI client, creating it on first use.
+    All consumers share its HTTP/2 connection pool, so TLS setup happens once per process.
+    """
+    global _async_openai_client
+    if _async_openai_client is None:
+        _async_openai_client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            timeout=OPENAI_TIMEOUT,
+            http_client=DefaultAsyncHttpxClient(http2=True, limits=HTTP_LIMITS)
+        )
+    return _async_openai_client
+
+
+async def stream_response(**params):
+    """
+    Start a streamed Responses API call on the shared async client.
+    The body is encoded once with orjson and sent as is, skipping the SDK's
+    per-field transform and stdlib JSON encoding of the (possibly long) input.
+    Retries and error types (e.g. BadRequestError.param) are the SDK's own.
+    """
+    return await get_async_openai_client().post(
+        '/responses',
+        body=orjson.dumps({**params, 'stream': True}),
+        cast_to=Response,
+        stream=True,
+        stream_cls=AsyncStream[ResponseStreamEvent]
+    )
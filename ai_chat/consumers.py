@@ -1,13 +1,41 @@
-import os
-import json
+import time
+from datetime import timedelta
+import orjson
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from openai import OpenAI
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from openai import BadRequestError, NotFoundError
 
+from .cache import (
+    HISTORY_CACHE_TIMEOUT,
+    OWNER_CACHE_TIMEOUT,
+    aacquire_turn_lock,
+    ahistory_version,
+    arelease_turn_lock,
+    history_cache_key,
+    owner_cache_key
+)
+from .clients import REPLY_TIMEOUT, IncompleteResponseError, stream_response
+from .history import asave_history, extend_history, load_history
 from .models import AIChat, AIMessage
+from .tokens import count_tokens, fit_history
 from chat.models import Message
 
 
+# Streamed deltas are coalesced and flushed once this many characters are
+# buffered or this many seconds have passed since the last flush
+DELTA_FLUSH_CHARS = 64
+DELTA_FLUSH_INTERVAL = 0.05
+
+# A message repeated within this window is answered with the saved reply
+REPLAY_WINDOW = timedelta(seconds=30)
+
+
 class AIChatConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for real-time AI chat with ChatGPT.
@@ -49,25 +77,50 @@ class AIChatConsumer(AsyncWebsocketConsumer):
     async def receive(self, text_data):
         """Handle incoming WebSocket messages"""
         try:
-            data = json.loads(text_data)
+            data = orjson.loads(text_data)
             message_type = data.get('type', 'message')
             
             if message_type == 'message':
                 await self.handle_user_message(data)
             elif message_type == 'typing':
-                # Optionally handle typing indicators
-                pass
+                # Let the user's other open tabs show the indicator
+                await self.broadcast({'type': 'typing'}, echo=False)
                 
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+        except orjson.JSONDecodeError:
+            await self.send(text_data=orjson.dumps({
                 'type': 'error',
                 'message': 'Invalid JSON'
-            }))
+            }).decode())
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=orjson.dumps({
                 'type': 'error',
                 'message': str(e)
-            }))
+            }).decode())
+    
+    async def broadcast(self, payload, echo=True):
+        """
+        Send an event to every socket open on this AI chat, serializing it once.
+        This socket sends directly (unless echo is False): it is busy handling the
+        current message and would only get the group copy after the reply has streamed.
+        """
+        text = orjson.dumps(payload).decode()
+        if echo:
+            await self.send(text_data=text)
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'ai.broadcast',
+            'text': text,
+            'sender_channel_name': self.channel_name
+        })
+    
+    async def ai_broadcast(self, event):
+        """Forward an event from another socket on this AI chat"""
+        if event['sender_channel_name'] != self.channel_name:
+            await self.send(text_data=event['text'])
+    
+    async def ai_invalidate(self, event):
+        """Reload per-socket chat state after the AI chat changed on any instance"""
+        if not await self.check_ownership():
+            await self.close()
     
     async def handle_user_message(self, data):
         """Process user message and get ChatGPT response"""
@@ -76,143 +129,301 @@ class AIChatConsumer(AsyncWebsocketConsumer):
         context_limit = data.get('context_message_limit', 20)
         
         if not content:
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=orjson.dumps({
                 'type': 'error',
                 'message': 'Message content cannot be empty'
-            }))
+            }).decode())
+            return
+        
+        # Answer a replayed message (e.g. a resend after a flaky reconnect)
+        # with the reply already saved instead of calling OpenAI again
+        replayed_reply = await self.find_replayed_reply(content)
+        if replayed_reply is not None:
+            await self.send(text_data=orjson.dumps({
+                'type': 'assistant_done',
+                'message': {
+                    'id': replayed_reply.id,
+                    'role': 'assistant',
+                    'content': replayed_reply.content,
+                    'timestamp': replayed_reply.timestamp.isoformat(),
+                    'usage': {
+                        'prompt_tokens': replayed_reply.prompt_tokens,
+                        'completion_tokens': replayed_reply.completion_tokens,
+                        'total_tokens': replayed_reply.total_tokens
+                    }
+                }
+            }).decode())
+            return
+        
+        # One turn at a time per chat, across tabs and the REST endpoint
+        lock_token = await aacquire_turn_lock(self.ai_chat_id)
+        if lock_token is None:
+            await self.send(text_data=orjson.dumps({
+                'type': 'error',
+                'message': 'A reply is already being generated for this chat'
+            }).decode())
             return
         
-        # Save user message
-        user_message = await self.save_message('user', content)
-        
-        # Send user message to client
-        await self.send(text_data=json.dumps({
-            'type': 'user_message',
-            'message': {
-                'id': user_message.id,
-                'role': 'user',
-                'content': content,
-                'timestamp': user_message.timestamp.isoformat()
-            }
-        }))
-        
-        # Get ChatGPT response
         try:
-            assistant_content, usage = await self.get_chatgpt_response(
-                include_context,
-                context_limit
-            )
-            
-            # Save assistant message
-            assistant_message = await self.save_message(
-                'assistant',
-                assistant_content,
-                prompt_tokens=usage.get('prompt_tokens'),
-                completion_tokens=usage.get('completion_tokens'),
-                total_tokens=usage.get('total_tokens')
-            )
+            # Read the prior turns
+            history = await self.get_history()
             
-            # Send assistant message to client
-            await self.send(text_data=json.dumps({
-                'type': 'assistant_message',
+            # Echo the user message to the client; it is saved with the reply
+            await self.broadcast({
+                'type': 'user_message',
                 'message': {
-                    'id': assistant_message.id,
-                    'role': 'assistant',
-                    'content': assistant_content,
-                    'timestamp': assistant_message.timestamp.isoformat(),
-                    'usage': usage
+                    'role': 'user',
+                    'content': content,
+                    'timestamp': timezone.now().isoformat()
                 }
-            }))
+            })
             
-        except Exception as e:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': f'Failed to get ChatGPT response: {str(e)}'
-            }))
+            # Get ChatGPT response
+            try:
+                assistant_content, usage, response_id = await self.get_chatgpt_response(
+                    history,
+                    content,
+                    include_context,
+                    context_limit
+                )
+                
+                # Save both messages and continue from this response on the next turn
+                assistant_message = await self.save_pair(
+                    content,
+                    assistant_content,
+                    usage,
+                    response_id
+                )
+                
+                # Extend the cached history with the completed turn, unless the chat changed meanwhile
+                extended = await sync_to_async(extend_history, thread_sensitive=False)(
+                    history,
+                    content,
+                    assistant_content,
+                    usage.get('completion_tokens'),
+                    response_id
+                )
+                await asave_history(self.ai_chat_id, extended)
+                
+                # Signal the end of the stream with the saved message
+                await self.broadcast({
+                    'type': 'assistant_done',
+                    'message': {
+                        'id': assistant_message.id,
+                        'role': 'assistant',
+                        'content': assistant_content,
+                        'timestamp': assistant_message.timestamp.isoformat(),
+                        'usage': usage
+                    }
+                })
+                
+            except Exception as e:
+                await self.send(text_data=orjson.dumps({
+                    'type': 'error',
+                    'message': f'Failed to get ChatGPT response: {str(e)}'
+                }).decode())
+        finally:
+            await arelease_turn_lock(self.ai_chat_id, lock_token)
     
-    async def get_chatgpt_response(self, include_context, context_limit):
-        """Call OpenAI API and get response"""
-        # Prepare messages
-        messages = await self.prepare_messages(include_context, context_limit)
-        
-        # Call OpenAI API (sync operation in thread pool)
-        def call_openai():
-            client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-            response = client.chat.completions.create(
-                model=os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo'),
-                messages=messages
+    async def get_chatgpt_response(self, history, content, include_context, context_limit):
+        """
+        Stream the OpenAI response to the client and return the full reply.
+        Only the new turn is sent when the previous response can be continued.
+        """
+        messages = history['messages']
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        
+        # Optionally add related chat context
+        context_text = ''
+        if include_context and self.related_chat_id:
+            context_text = await self.get_related_context(context_limit)
+        instructions = messages[0]['content'] + context_text
+        
+        new_turn = [{'role': 'user', 'content': content}]
+        model = settings.OPENAI_MODEL
+        
+        stream = None
+        if self.previous_response_id:
+            try:
+                stream = await stream_response(
+                    model=model,
+                    instructions=instructions,
+                    input=new_turn,
+                    previous_response_id=self.previous_response_id,
+                    truncation='auto'
+                )
+            except (BadRequestError, NotFoundError) as e:
+                if e.param != 'previous_response_id':
+                    raise
+                # The stored response is gone; resend the full history instead
+                self.previous_response_id = None
+        
+        if stream is None:
+            # Send as much recent history as fits next to the instructions and reply.
+            # Tokenizing is CPU work (and may first download the encoding), so it runs
+            # off the event loop
+            budget = (
+                settings.OPENAI_CONTEXT_TOKENS
+                - settings.OPENAI_RESPONSE_TOKENS
+                - history['tokens'][0]
+                - await sync_to_async(count_tokens, thread_sensitive=False)(context_text + content)
+            )
+            stream = await stream_response(
+                model=model,
+                instructions=instructions,
+                input=fit_history(messages[1:], history['tokens'][1:], budget) + new_turn
             )
-            return response
         
-        # Run in thread pool to avoid blocking
-        from asgiref.sync import sync_to_async
-        response = await sync_to_async(call_openai)()
+        # Forward deltas in small batches; id and usage come with completion
+        parts = []
+        buffer = []
+        buffer_len = 0
+        last_flush = time.monotonic()
+        usage = {}
+        response_id = None
+        async for event in stream:
+            # Give up on a reply that would outlive the turn lock
+            if time.monotonic() > deadline:
+                raise IncompleteResponseError('The response took too long')
+            if event.type == 'response.output_text.delta':
+                parts.append(event.delta)
+                buffer.append(event.delta)
+                buffer_len += len(event.delta)
+                if (buffer_len >= DELTA_FLUSH_CHARS
+                        or time.monotonic() - last_flush >= DELTA_FLUSH_INTERVAL):
+                    await self.broadcast({
+                        'type': 'assistant_delta',
+                        'content': ''.join(buffer)
+                    })
+                    buffer = []
+                    buffer_len = 0
+                    last_flush = time.monotonic()
+            elif event.type == 'response.completed':
+                response_id = event.response.id
+                usage = {
+                    'prompt_tokens': event.response.usage.input_tokens,
+                    'completion_tokens': event.response.usage.output_tokens,
+                    'total_tokens': event.response.usage.total_tokens
+                }
+            elif event.type == 'response.failed':
+                error = event.response.error
+                raise IncompleteResponseError(error.message if error else 'The response failed')
+            elif event.type == 'response.incomplete':
+                details = event.response.incomplete_details
+                raise IncompleteResponseError(
+                    f'The response is incomplete: {details.reason if details else "unknown reason"}'
+                )
+            elif event.type == 'error':
+                raise IncompleteResponseError(event.message)
+        
+        if response_id is None:
+            raise IncompleteResponseError('The response ended before it was completed')
         
-        content = response.choices[0].message.content
-        usage = {
-            'prompt_tokens': response.usage.prompt_tokens,
-            'completion_tokens': response.usage.completion_tokens,
-            'total_tokens': response.usage.total_tokens
-        }
+        if buffer:
+            await self.broadcast({
+                'type': 'assistant_delta',
+                'content': ''.join(buffer)
+            })
         
-        return content, usage
+        return ''.join(parts), usage, response_id
+    
+    async def get_history(self):
+        """
+        Return the system prompt and prior turns with their token counts,
+        from the cache when possible.
+        Also restores the OpenAI response id that continues this history.
+        """
+        version = await ahistory_version(self.ai_chat_id)
+        key = history_cache_key(self.ai_chat_id, version)
+        history = await cache.aget(key)
+        if history is None:
+            history = {**await database_sync_to_async(load_history)(self.ai_chat_id), 'version': version}
+            await cache.aset(key, history, timeout=HISTORY_CACHE_TIMEOUT)
+        self.previous_response_id = history['previous_response_id']
+        return history
+    
+    async def check_ownership(self):
+        """
+        Check if the user owns this AI chat.
+        Also keeps the related chat id so it is read once per socket.
+        """
+        key = owner_cache_key(self.ai_chat_id)
+        owner = await cache.aget(key)
+        if owner is None:
+            owner = await self.load_owner()
+            if owner is None:
+                return False
+            await cache.aset(key, owner, timeout=OWNER_CACHE_TIMEOUT)
+        user_id, self.related_chat_id = owner
+        return user_id == self.user.id
     
     @database_sync_to_async
-    def check_ownership(self):
-        """Check if the user owns this AI chat"""
-        try:
-            ai_chat = AIChat.objects.get(id=self.ai_chat_id)
-            return ai_chat.user == self.user
-        except AIChat.DoesNotExist:
-            return False
+    def load_owner(self):
+        """Load the owner and related chat id of this AI chat"""
+        return AIChat.objects.filter(id=self.ai_chat_id).values_list(
+            'user_id', 'related_chat_id'
+        ).first()
     
     @database_sync_to_async
-    def save_message(self, role, content, prompt_tokens=None, completion_tokens=None, total_tokens=None):
-        """Save a message to the database"""
-        ai_chat = AIChat.objects.get(id=self.ai_chat_id)
-        message = AIMessage.objects.create(
-            ai_chat=ai_chat,
-            role=role,
-            content=content,
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            total_tokens=total_tokens
-        )
-        return message
+    def save_pair(self, user_content, assistant_content, usage, response_id):
+        """
+        Save the user message and the assistant reply in one transaction.
+        Returns the assistant message.
+        """
+        with transaction.atomic():
+            assistant_message = AIMessage.objects.bulk_create([
+                AIMessage(
+                    ai_chat_id=self.ai_chat_id,
+                    role='user',
+                    content=user_content,
+                    content_sha=AIMessage.content_digest(user_content)
+                ),
+                AIMessage(ai_chat_id=self.ai_chat_id, role='assistant', content=assistant_content, **usage)
+            ])[1]
+            # bulk_create skips the signal that keeps message_count in sync
+            AIChat.objects.filter(id=self.ai_chat_id).update(
+                previous_response_id=response_id,
+                message_count=F('message_count') + 2
+            )
+        return assistant_message
     
     @database_sync_to_async
-    def prepare_messages(self, include_context, context_limit):
-        """Prepare messages for OpenAI API"""
-        ai_chat = AIChat.objects.get(id=self.ai_chat_id)
-        messages = []
-        
-        # Add system prompt
-        system_content = ai_chat.system_prompt
-        
-        # Optionally add related chat context
-        if include_context and ai_chat.related_chat:
-            related_messages = Message.objects.filter(
-                chat=ai_chat.related_chat
-            ).select_related('sender').order_by('-timestamp')[:context_limit]
-            
-            if related_messages:
-                context_text = "\n\nContext from related chat:\n"
-                for msg in reversed(related_messages):
-                    context_text += f"{msg.sender.username}: {msg.content}\n"
-                system_content += context_text
-        
-        messages.append({
-            'role': 'system',
-            'content': system_content
-        })
+    def find_replayed_reply(self, content):
+        """
+        Return the saved reply if the last turn answered the same message within REPLAY_WINDOW.
+        Only the last turn counts: an earlier identical message was answered in another context.
+        """
+        last_turn = list(AIMessage.objects.filter(
+            ai_chat_id=self.ai_chat_id,
+            role__in=('user', 'assistant')
+        ).order_by('-id')[:2])
+        if len(last_turn) < 2:
+            return None
+        reply, user_message = last_turn
+        if (
+            reply.role == 'assistant'
+            and user_message.role == 'user'
+            and user_message.content_sha is not None
+            and bytes(user_message.content_sha) == AIMessage.content_digest(content)
+            and user_message.timestamp > timezone.now() - REPLAY_WINDOW
+        ):
+            return reply
+        return None
+    
+    @database_sync_to_async
+    def get_related_context(self, context_limit):
+        """Format recent messages of the related chat for the system prompt"""
+        latest = Message.objects.filter(
+            chat_id=self.related_chat_id
+        ).order_by('-timestamp').values('pk')[:context_limit]
+        related_messages = list(Message.objects.filter(
+            pk__in=latest
+        ).order_by('timestamp').values_list('sender_username', 'content'))
         
-        # Add conversation history
-        ai_messages = AIMessage.objects.filter(ai_chat=ai_chat).order_by('timestamp')
-        for msg in ai_messages:
-            if msg.role in ['user', 'assistant']:
-                messages.append({
-                    'role': msg.role,
-                    'content': msg.content
-                })
+        if not related_messages:
+            return ''
         
-        return messages
+        return "\n\nContext from related chat:\n" + "".join(
+            f"{username}: {content}\n"
+            for username, content in related_messages
+        )
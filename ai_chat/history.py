@@ -0,0 +1,83 @@
+"""
+Conversation history of an AI chat as sent to OpenAI, shared by the consumer
+and the views through the cache.
+
+A history entry holds the system prompt and prior turns, the token count of
+each of them, the OpenAI response id that continues the conversation and the
+cache version it was read under.
+"""
+from django.core.cache import cache
+
+from .cache import HISTORY_CACHE_TIMEOUT, history_cache_key, history_version
+from .models import AIChat, AIMessage
+from .tokens import count_tokens
+
+
+def load_history(ai_chat_id):
+    """Load the history entry of an AI chat from the database"""
+    system_prompt, system_prompt_tokens, previous_response_id = AIChat.objects.filter(
+        id=ai_chat_id
+    ).values_list('system_prompt', 'system_prompt_tokens', 'previous_response_id').first()
+    if system_prompt and not system_prompt_tokens:
+        # Chats from before system_prompt_tokens existed are counted on first use
+        system_prompt_tokens = count_tokens(system_prompt)
+        AIChat.objects.filter(id=ai_chat_id, system_prompt=system_prompt).update(
+            system_prompt_tokens=system_prompt_tokens
+        )
+    messages = [{'role': 'system', 'content': system_prompt}]
+    tokens = [system_prompt_tokens]
+
+    ai_messages = AIMessage.objects.filter(
+        ai_chat_id=ai_chat_id,
+        role__in=('user', 'assistant')
+    ).order_by('id').values_list('role', 'content', 'completion_tokens')
+    for role, content, completion_tokens in ai_messages.iterator(chunk_size=200):
+        messages.append({'role': role, 'content': content})
+        # A reply's completion tokens are its own length; user turns are counted
+        tokens.append(completion_tokens or count_tokens(content))
+
+    return {
+        'messages': messages,
+        'tokens': tokens,
+        'previous_response_id': previous_response_id
+    }
+
+
+def get_history(ai_chat_id):
+    """Return the history entry of an AI chat, from the cache when possible"""
+    version = history_version(ai_chat_id)
+    key = history_cache_key(ai_chat_id, version)
+    history = cache.get(key)
+    if history is None:
+        history = {**load_history(ai_chat_id), 'version': version}
+        cache.set(key, history, timeout=HISTORY_CACHE_TIMEOUT)
+    return history
+
+
+def extend_history(history, user_content, assistant_content, completion_tokens, response_id):
+    """Return a history entry with one more user/assistant turn"""
+    return {
+        'messages': history['messages'] + [
+            {'role': 'user', 'content': user_content},
+            {'role': 'assistant', 'content': assistant_content}
+        ],
+        'tokens': history['tokens'] + [
+            count_tokens(user_content),
+            completion_tokens or count_tokens(assistant_content)
+        ],
+        'previous_response_id': response_id,
+        'version': history['version']
+    }
+
+
+def save_history(ai_chat_id, history):
+    """
+    Cache a history entry under the version it was read under.
+    If the chat changed since, that version is no longer read and the entry just expires.
+    """
+    cache.set(history_cache_key(ai_chat_id, history['version']), history, timeout=HISTORY_CACHE_TIMEOUT)
+
+
+async def asave_history(ai_chat_id, history):
+    """Async version of save_history"""
+    await cache.aset(history_cache_key(ai_chat_id, history['version']), history, timeout=HISTORY_CACHE_TIMEOUT)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-15 01:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aichat',
+            name='previous_response_id',
+            field=models.CharField(blank=True, help_text='ID of the last OpenAI response, used to continue the conversation server-side', max_length=128, null=True),
+        ),
+    ]
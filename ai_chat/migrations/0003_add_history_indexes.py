@@ -0,0 +1,24 @@
+# Generated by Django 5.2.7 on 2026-10-15 02:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_chat', '0002_aichat_previous_response_id'),
+        ('chat', '0002_alter_chat_name_alter_chat_participants_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aichat',
+            index=models.Index(fields=['user', '-updated_at'], name='ai_chat_aic_user_id_850e4a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aimessage',
+            index=models.Index(fields=['ai_chat', 'timestamp'], name='ai_chat_aim_ai_chat_8b6b53_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-15 02:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_message_count(apps, schema_editor):
+    AIChat = apps.get_model('ai_chat', 'AIChat')
+    AIMessage = apps.get_model('ai_chat', 'AIMessage')
+    counts = AIMessage.objects.filter(
+        ai_chat=OuterRef('pk')
+    ).order_by().values('ai_chat').annotate(count=Count('pk')).values('count')
+    AIChat.objects.update(message_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_chat', '0003_add_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aichat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of messages in this AI chat, kept in sync as messages are saved'),
+        ),
+        migrations.RunPython(backfill_message_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-15 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_chat', '0004_aichat_message_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aichat',
+            name='system_prompt_tokens',
+            field=models.PositiveIntegerField(default=0, help_text='Number of tokens in the system prompt, counted on save'),
+        ),
+    ]
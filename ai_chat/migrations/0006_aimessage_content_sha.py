@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-15 01:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_chat', '0005_aichat_system_prompt_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimessage',
+            name='content_sha',
+            field=models.BinaryField(blank=True, db_index=True, help_text='SHA-256 of the content, used to detect replayed messages', max_length=32, null=True),
+        ),
+    ]
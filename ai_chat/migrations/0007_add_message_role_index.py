@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-15 01:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_chat', '0006_aimessage_content_sha'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aimessage',
+            index=models.Index(fields=['ai_chat', 'role', 'id'], name='ai_chat_aim_ai_chat_dd9f03_idx'),
+        ),
+    ]
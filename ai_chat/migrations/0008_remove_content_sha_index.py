@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-15 02:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_chat', '0007_add_message_role_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='aimessage',
+            name='content_sha',
+            field=models.BinaryField(blank=True, help_text='SHA-256 of the content, used to detect replayed messages', max_length=32, null=True),
+        ),
+    ]
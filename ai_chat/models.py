@@ -1,6 +1,12 @@
-from django.db import models
+import hashlib
+
+from django.db import models, transaction
+from django.db.models import F
 from django.conf import settings
 
+from .cache import invalidate_history_on_commit
+from .tokens import count_tokens
+
 
 class AIChat(models.Model):
     """
@@ -29,15 +35,55 @@ class AIChat(models.Model):
         default='You are a helpful assistant.',
         help_text='System prompt for ChatGPT'
     )
+    system_prompt_tokens = models.PositiveIntegerField(
+        default=0,
+        help_text='Number of tokens in the system prompt, counted on save'
+    )
+    previous_response_id = models.CharField(
+        max_length=128,
+        null=True,
+        blank=True,
+        help_text='ID of the last OpenAI response, used to continue the conversation server-side'
+    )
+    message_count = models.PositiveIntegerField(
+        default=0,
+        help_text='Number of messages in this AI chat, kept in sync as messages are saved'
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['user', '-updated_at']),
+        ]
 
     def __str__(self):
         return f"{self.title} - {self.user.username}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stored token count belongs to the prompt as loaded
+        instance._counted_system_prompt = instance.__dict__.get('system_prompt')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Tokenize the system prompt when it changes instead of on every turn
+        update_fields = kwargs.get('update_fields')
+        recount = (
+            (update_fields is None or 'system_prompt' in update_fields)
+            and 'system_prompt' not in self.get_deferred_fields()
+            and self.system_prompt != getattr(self, '_counted_system_prompt', None)
+        )
+        if recount:
+            self.system_prompt_tokens = count_tokens(self.system_prompt)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'system_prompt_tokens'}
+        super().save(*args, **kwargs)
+        if recount:
+            self._counted_system_prompt = self.system_prompt
+
 
 class AIMessage(models.Model):
     """
@@ -62,6 +108,12 @@ class AIMessage(models.Model):
         help_text='Role of the message sender'
     )
     content = models.TextField(help_text='Message content')
+    content_sha = models.BinaryField(
+        max_length=32,
+        null=True,
+        blank=True,
+        help_text='SHA-256 of the content, used to detect replayed messages'
+    )
     timestamp = models.DateTimeField(auto_now_add=True)
     
     # Optional: Store token usage for cost tracking
@@ -71,6 +123,24 @@ class AIMessage(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['ai_chat', 'timestamp']),
+            models.Index(fields=['ai_chat', 'role', 'id']),
+        ]
 
     def __str__(self):
         return f"{self.role} in {self.ai_chat.title} at {self.timestamp}"
+
+    def delete(self, *args, **kwargs):
+        # Uncounted and invalidated here rather than in post_delete receivers, which would
+        # make every chat and user delete load and handle its messages one by one
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            AIChat.objects.filter(pk=self.ai_chat_id).update(message_count=F('message_count') - 1)
+            invalidate_history_on_commit(self.ai_chat_id)
+        return result
+
+    @staticmethod
+    def content_digest(content):
+        """Return the value stored in content_sha for the given content"""
+        return hashlib.sha256(content.encode()).digest()
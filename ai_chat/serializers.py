@@ -23,10 +23,8 @@ class AIMessageSerializer(serializers.ModelSerializer):
 
 class AIChatSerializer(serializers.ModelSerializer):
     """Serializer for AI chats"""
-    messages = AIMessageSerializer(many=True, read_only=True)
     user_username = serializers.CharField(source='user.username', read_only=True)
     related_chat_name = serializers.CharField(source='related_chat.name', read_only=True, allow_null=True)
-    message_count = serializers.SerializerMethodField()
     
     class Meta:
         model = AIChat
@@ -40,14 +38,17 @@ class AIChatSerializer(serializers.ModelSerializer):
             'system_prompt',
             'created_at',
             'updated_at',
-            'messages',
             'message_count'
         ]
-        read_only_fields = ['id', 'user', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'user', 'created_at', 'updated_at', 'message_count']
+
+
+class AIChatDetailSerializer(AIChatSerializer):
+    """Serializer for AI chats including all their messages"""
+    messages = AIMessageSerializer(many=True, read_only=True)
     
-    def get_message_count(self, obj):
-        """Get the total number of messages in this AI chat"""
-        return obj.messages.count()
+    class Meta(AIChatSerializer.Meta):
+        fields = AIChatSerializer.Meta.fields + ['messages']
 
 
 class AIChatCreateSerializer(serializers.ModelSerializer):
@@ -94,3 +95,7 @@ class SendAIMessageSerializer(serializers.Serializer):
         max_value=100,
         help_text='Number of recent messages from related chat to include'
     )
+    stream = serializers.BooleanField(
+        default=False,
+        help_text='Stream the reply as server-sent events instead of waiting for the full response'
+    )
@@ -0,0 +1,48 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import history_version_key, invalidate_history_on_commit, owner_cache_key
+from .models import AIChat, AIMessage
+
+
+@receiver(post_save, sender=AIChat)
+@receiver(post_delete, sender=AIChat)
+def invalidate_chat_cache(sender, instance, **kwargs):
+    """
+    Drop the cached history and owner when the chat (e.g. its system prompt) changes.
+    Open sockets on every instance are told to reload the state they keep themselves.
+    Both wait for the commit, so a concurrent read cannot re-cache the old state and
+    nothing is invalidated for a change that is rolled back.
+    """
+    ai_chat_id = instance.pk
+    
+    def invalidate():
+        cache.delete_many([history_version_key(ai_chat_id), owner_cache_key(ai_chat_id)])
+        async_to_sync(get_channel_layer().group_send)(
+            f'ai_chat_{ai_chat_id}',
+            {'type': 'ai.invalidate'}
+        )
+    
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=AIMessage)
+def invalidate_message_history(sender, instance, **kwargs):
+    """
+    Drop the cached history when a message is saved outside the consumer, once committed.
+    Deletes invalidate in AIMessage.delete() and with the chat instead, as a post_delete
+    receiver would run once per message of every cascade
+    """
+    invalidate_history_on_commit(instance.ai_chat_id)
+
+
+@receiver(post_save, sender=AIMessage)
+def increment_message_count(sender, instance, created, **kwargs):
+    """Count a new message on its chat"""
+    if created:
+        AIChat.objects.filter(pk=instance.ai_chat_id).update(message_count=F('message_count') + 1)
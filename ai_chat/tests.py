@@ -1,19 +1,39 @@
 import json
-from unittest.mock import Mock, patch
-from django.test import TestCase, TransactionTestCase
+from unittest.mock import AsyncMock, Mock, patch
+import httpx
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
+from openai import AsyncOpenAI, BadRequestError
 
+from .cache import history_version_key, turn_lock_key
+from .clients import OPENAI_TIMEOUT, get_openai_client, stream_response
+from .history import get_history
 from .models import AIChat, AIMessage
+from .tokens import count_tokens
 from chat.models import Chat, Message
 from .consumers import AIChatConsumer
 
 User = get_user_model()
 
 
+def make_stream(*deltas, usage=None, response_id='resp_1'):
+    """Build an async iterator of OpenAI Responses API stream events"""
+    if usage is None:
+        usage = Mock(input_tokens=0, output_tokens=0, total_tokens=0)
+    
+    async def stream():
+        for delta in deltas:
+            yield Mock(type='response.output_text.delta', delta=delta)
+        yield Mock(type='response.completed', response=Mock(id=response_id, usage=usage))
+    return stream()
+
+
 # =============================================================================
 # MODEL TESTS (Unit Tests)
 # =============================================================================
@@ -22,6 +42,7 @@ class AIChatModelTest(TestCase):
     """Unit tests for AIChat model"""
     
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user(
             username='testuser',
             email='test@example.com',
@@ -71,6 +92,78 @@ class AIChatModelTest(TestCase):
         self.assertEqual(chats[0], ai_chat2)  # Most recent first
         self.assertEqual(chats[1], ai_chat1)
 
+    
+    def test_saving_ai_chat_invalidates_cached_history(self):
+        """Test that changing an AI chat drops its cached message history"""
+        ai_chat = AIChat.objects.create(user=self.user, title='Test AI Chat', system_prompt='Old')
+        get_history(ai_chat.id)
+        
+        ai_chat.system_prompt = 'New prompt'
+        with self.captureOnCommitCallbacks(execute=True):
+            ai_chat.save()
+            # Nothing is dropped before the change is committed
+            self.assertIsNotNone(cache.get(history_version_key(ai_chat.id)))
+        
+        self.assertIsNone(cache.get(history_version_key(ai_chat.id)))
+        self.assertEqual(get_history(ai_chat.id)['messages'][0]['content'], 'New prompt')
+    
+    def test_rolled_back_change_keeps_cached_history(self):
+        """Test that a change that is rolled back does not drop the cached history"""
+        ai_chat = AIChat.objects.create(user=self.user, title='Test AI Chat')
+        get_history(ai_chat.id)
+        
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    ai_chat.save()
+                    raise RuntimeError
+        
+        self.assertEqual(callbacks, [])
+        self.assertIsNotNone(cache.get(history_version_key(ai_chat.id)))
+    
+    def test_delete_ai_chat_invalidates_once(self):
+        """Test that deleting a chat invalidates its caches once, not once per message"""
+        ai_chat = AIChat.objects.create(user=self.user, title='Test AI Chat')
+        for i in range(3):
+            AIMessage.objects.create(ai_chat=ai_chat, role='user', content=f'Message {i}')
+        
+        with self.captureOnCommitCallbacks() as callbacks:
+            ai_chat.delete()
+        
+        self.assertEqual(len(callbacks), 1)
+    
+    def test_system_prompt_tokens_counted_on_save(self):
+        """Test that the system prompt token count is refreshed when it changes"""
+        ai_chat = AIChat.objects.create(user=self.user, title='Test AI Chat', system_prompt='Hi')
+        self.assertEqual(ai_chat.system_prompt_tokens, count_tokens('Hi'))
+        
+        ai_chat.system_prompt = 'You are a very thorough and patient assistant.'
+        ai_chat.save(update_fields=['system_prompt'])
+        ai_chat.refresh_from_db()
+        self.assertEqual(
+            ai_chat.system_prompt_tokens,
+            count_tokens('You are a very thorough and patient assistant.')
+        )
+    
+    def test_system_prompt_tokens_not_recounted_when_unchanged(self):
+        """Test that saving a chat whose system prompt did not change skips tokenizing it"""
+        ai_chat = AIChat.objects.create(user=self.user, title='Test AI Chat')
+        
+        with patch('ai_chat.models.count_tokens') as mock_count_tokens:
+            ai_chat.title = 'Renamed'
+            ai_chat.save()
+            AIChat.objects.get(pk=ai_chat.pk).save()
+        
+        mock_count_tokens.assert_not_called()
+    
+    def test_uncounted_system_prompt_counted_on_first_use(self):
+        """Test that a chat saved before system_prompt_tokens existed is counted when its history loads"""
+        ai_chat = AIChat.objects.create(user=self.user, title='Test AI Chat', system_prompt='Hi')
+        AIChat.objects.filter(pk=ai_chat.pk).update(system_prompt_tokens=0)
+        
+        self.assertEqual(get_history(ai_chat.id)['tokens'][0], count_tokens('Hi'))
+        ai_chat.refresh_from_db()
+        self.assertEqual(ai_chat.system_prompt_tokens, count_tokens('Hi'))
 
 class AIMessageModelTest(TestCase):
     """Unit tests for AIMessage model"""
@@ -127,6 +220,60 @@ class AIMessageModelTest(TestCase):
         self.assertEqual(messages[0], msg1)
         self.assertEqual(messages[1], msg2)
     
+    def test_message_count_tracks_created_and_deleted_messages(self):
+        """Test that AIChat.message_count follows message creation and deletion"""
+        message = AIMessage.objects.create(ai_chat=self.ai_chat, role='user', content='Hello')
+        AIMessage.objects.create(ai_chat=self.ai_chat, role='assistant', content='Hi')
+        self.ai_chat.refresh_from_db()
+        self.assertEqual(self.ai_chat.message_count, 2)
+        
+        get_history(self.ai_chat.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            message.delete()
+        self.ai_chat.refresh_from_db()
+        self.assertEqual(self.ai_chat.message_count, 1)
+        self.assertIsNone(cache.get(history_version_key(self.ai_chat.id)))
+    
+    def test_admin_changelist_defers_content(self):
+        """Test that the admin message list shows previews without loading message bodies"""
+        AIMessage.objects.create(ai_chat=self.ai_chat, role='user', content='x' * 100)
+        self.client.force_login(User.objects.create_superuser(username='admin', password='testpass123'))
+        
+        response = self.client.get('/admin/ai_chat/aimessage/')
+        
+        self.assertEqual(response.status_code, 200)
+        message = response.context['cl'].result_list[0]
+        self.assertIn('content', message.get_deferred_fields())
+        self.assertContains(response, 'x' * 50 + '...')
+    
+    def test_admin_delete_selected_uncounts_messages(self):
+        """Test that deleting messages from the admin list uncounts them per chat"""
+        other_chat = AIChat.objects.create(user=self.user, title='Other Chat')
+        for ai_chat in (self.ai_chat, self.ai_chat, other_chat):
+            AIMessage.objects.create(ai_chat=ai_chat, role='user', content='Hello')
+        self.client.force_login(User.objects.create_superuser(username='admin', password='testpass123'))
+        
+        response = self.client.post('/admin/ai_chat/aimessage/', {
+            'action': 'delete_selected',
+            '_selected_action': list(AIMessage.objects.values_list('pk', flat=True)),
+            'post': 'yes'
+        })
+        
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(AIMessage.objects.exists())
+        self.ai_chat.refresh_from_db()
+        other_chat.refresh_from_db()
+        self.assertEqual((self.ai_chat.message_count, other_chat.message_count), (0, 0))
+    
+    def test_delete_user_with_drifted_message_count(self):
+        """Test that deleting a user does not uncount the messages of chats deleted with it"""
+        AIMessage.objects.create(ai_chat=self.ai_chat, role='user', content='Hello')
+        AIChat.objects.filter(pk=self.ai_chat.pk).update(message_count=0)
+        
+        self.user.delete()
+        
+        self.assertFalse(AIMessage.objects.exists())
+    
     def test_message_string_representation(self):
         """Test AIMessage __str__ method"""
         message = AIMessage.objects.create(
@@ -138,6 +285,44 @@ class AIMessageModelTest(TestCase):
         self.assertEqual(str(message), expected)
 
 
+class OpenAIClientTest(TestCase):
+    """Unit tests for the shared OpenAI client helpers"""
+    
+    @patch('ai_chat.clients.get_async_openai_client')
+    async def test_stream_response_sends_prebuilt_body(self, mock_get_client):
+        """Test that stream_response posts the orjson body as is and parses the event stream"""
+        requests = []
+        
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, headers={'content-type': 'text/event-stream'}, content=(
+                b'data: {"type":"response.output_text.delta","delta":"Hi","item_id":"msg_1",'
+                b'"output_index":0,"content_index":0,"sequence_number":1,"logprobs":[]}\n\n'
+            ))
+        
+        mock_get_client.return_value = AsyncOpenAI(
+            api_key='test',
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        
+        stream = await stream_response(model='gpt-test', input=[{'role': 'user', 'content': 'Hello'}])
+        events = [event async for event in stream]
+        
+        self.assertEqual(json.loads(requests[0].content), {
+            'model': 'gpt-test',
+            'input': [{'role': 'user', 'content': 'Hello'}],
+            'stream': True
+        })
+        self.assertEqual(requests[0].headers['content-type'], 'application/json')
+        self.assertEqual([(event.type, event.delta) for event in events], [('response.output_text.delta', 'Hi')])
+    
+    @override_settings(OPENAI_API_KEY='test')
+    @patch('ai_chat.clients._openai_client', None)
+    def test_sync_client_has_request_timeout(self):
+        """Test that the sync client is bounded like the async one, instead of the SDK's 600s default"""
+        self.assertEqual(get_openai_client().timeout, OPENAI_TIMEOUT)
+
+
 # =============================================================================
 # API TESTS (Integration Tests)
 # =============================================================================
@@ -146,6 +331,7 @@ class AIChatAPITest(APITestCase):
     """Integration tests for AI Chat REST API endpoints"""
     
     def setUp(self):
+        cache.clear()
         self.user1 = User.objects.create_user(
             username='user1',
             email='user1@example.com',
@@ -185,6 +371,18 @@ class AIChatAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 2)  # Only user1's chats
     
+    def test_list_ai_chats_omits_messages(self):
+        """Test that messages are only embedded in the list when requested"""
+        ai_chat = AIChat.objects.create(user=self.user1, title='Chat 1')
+        AIMessage.objects.create(ai_chat=ai_chat, role='user', content='Hello')
+        
+        response = self.client.get('/api/ai/chats/')
+        self.assertNotIn('messages', response.data[0])
+        self.assertEqual(response.data[0]['message_count'], 1)
+        
+        response = self.client.get('/api/ai/chats/?include=messages')
+        self.assertEqual(len(response.data[0]['messages']), 1)
+    
     def test_create_ai_chat_without_related_chat(self):
         """Test creating an AI chat without related chat"""
         data = {
@@ -261,6 +459,30 @@ class AIChatAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 2)
     
+    def test_get_messages_cached_until_new_message(self):
+        """Test that repeated message reads come from the cache until a message is added"""
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        AIMessage.objects.create(ai_chat=ai_chat, role='user', content='Message 1')
+        url = f'/api/ai/chats/{ai_chat.id}/messages/'
+        self.client.get(url)
+        
+        with self.assertNumQueries(2):  # chat lookup, latest message id
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 1)
+        
+        AIMessage.objects.create(ai_chat=ai_chat, role='assistant', content='Message 2')
+        response = self.client.get(url)
+        self.assertEqual([msg['content'] for msg in response.data], ['Message 1', 'Message 2'])
+    
+    def test_list_ai_chats_query_count(self):
+        """Test that listing AI chats takes one query regardless of the number of chats"""
+        for i in range(3):
+            AIChat.objects.create(user=self.user1, title=f'Chat {i}', related_chat=self.chat)
+        
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/ai/chats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
     def test_get_related_chat_context(self):
         """Test getting context from related chat"""
         ai_chat = AIChat.objects.create(
@@ -275,6 +497,35 @@ class AIChatAPITest(APITestCase):
         self.assertEqual(response.data['message_count'], 2)
         self.assertEqual(len(response.data['messages']), 2)
     
+    def test_get_related_chat_context_with_limit(self):
+        """Test that the limit keeps the latest messages in chronological order"""
+        Message.objects.create(chat=self.chat, sender=self.user1, content='Latest message')
+        ai_chat = AIChat.objects.create(
+            user=self.user1,
+            title='Test Chat',
+            related_chat=self.chat
+        )
+        
+        response = self.client.get(f'/api/ai/chats/{ai_chat.id}/related_chat_context/?message_limit=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [msg['content'] for msg in response.data['messages']],
+            [Message.objects.order_by('timestamp')[1].content, 'Latest message']
+        )
+    
+    def test_get_related_chat_context_after_username_change(self):
+        """Test that related chat context shows a sender's current username"""
+        self.user1.username = 'renamed'
+        self.user1.save()
+        ai_chat = AIChat.objects.create(
+            user=self.user1,
+            title='Test Chat',
+            related_chat=self.chat
+        )
+        
+        response = self.client.get(f'/api/ai/chats/{ai_chat.id}/related_chat_context/')
+        self.assertIn('renamed', [msg['sender'] for msg in response.data['messages']])
+    
     def test_get_related_chat_context_without_related_chat(self):
         """Test getting context when no related chat is linked"""
         ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
@@ -282,8 +533,8 @@ class AIChatAPITest(APITestCase):
         response = self.client.get(f'/api/ai/chats/{ai_chat.id}/related_chat_context/')
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
     
-    @patch('ai_chat.views.OpenAI')
-    def test_send_message_to_chatgpt(self, mock_openai):
+    @patch('ai_chat.views.get_openai_client')
+    def test_send_message_to_chatgpt(self, mock_get_client):
         """Test sending a message to ChatGPT"""
         # Mock OpenAI response
         mock_response = Mock()
@@ -291,7 +542,7 @@ class AIChatAPITest(APITestCase):
         mock_response.usage = Mock(prompt_tokens=10, completion_tokens=20, total_tokens=30)
         mock_client = Mock()
         mock_client.chat.completions.create.return_value = mock_response
-        mock_openai.return_value = mock_client
+        mock_get_client.return_value = mock_client
         
         ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
         
@@ -308,9 +559,120 @@ class AIChatAPITest(APITestCase):
         
         # Verify messages were created
         self.assertEqual(ai_chat.messages.count(), 2)  # User message + assistant response
+        ai_chat.refresh_from_db()
+        self.assertEqual(ai_chat.message_count, 2)
+        
+        # The new message is sent as the last turn
+        messages = mock_client.chat.completions.create.call_args[1]['messages']
+        self.assertEqual(messages[-1], {'role': 'user', 'content': 'Hello AI'})
     
-    @patch('ai_chat.views.OpenAI')
-    def test_send_message_with_related_chat_context(self, mock_openai):
+    @patch('ai_chat.views.get_openai_client')
+    def test_send_message_reuses_cached_history(self, mock_get_client):
+        """Test that consecutive sends build the prompt from the cached history"""
+        mock_response = Mock()
+        mock_response.choices = [Mock(message=Mock(content='AI response'))]
+        mock_response.usage = Mock(prompt_tokens=10, completion_tokens=20, total_tokens=30)
+        mock_client = Mock()
+        mock_client.chat.completions.create.return_value = mock_response
+        mock_get_client.return_value = mock_client
+        
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        url = f'/api/ai/chats/{ai_chat.id}/send_message/'
+        self.client.post(url, {'content': 'First'})
+        
+        with patch('ai_chat.history.load_history') as mock_load_history:
+            self.client.post(url, {'content': 'Second'})
+        mock_load_history.assert_not_called()
+        
+        messages = mock_client.chat.completions.create.call_args[1]['messages']
+        self.assertEqual(messages[1:], [
+            {'role': 'user', 'content': 'First'},
+            {'role': 'assistant', 'content': 'AI response'},
+            {'role': 'user', 'content': 'Second'},
+        ])
+    
+    @patch('ai_chat.views.get_openai_client')
+    def test_send_message_keeps_change_made_during_reply(self, mock_get_client):
+        """Test that a system prompt changed while a reply is generated is not overwritten"""
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat', system_prompt='Old')
+        
+        def create(**kwargs):
+            changed = AIChat.objects.get(pk=ai_chat.pk)
+            changed.system_prompt = 'New prompt'
+            with self.captureOnCommitCallbacks(execute=True):
+                changed.save()
+            return Mock(
+                choices=[Mock(message=Mock(content='AI response'))],
+                usage=Mock(prompt_tokens=10, completion_tokens=20, total_tokens=30)
+            )
+        
+        mock_client = Mock()
+        mock_client.chat.completions.create.side_effect = create
+        mock_get_client.return_value = mock_client
+        
+        self.client.post(f'/api/ai/chats/{ai_chat.id}/send_message/', {'content': 'Hello AI'})
+        
+        messages = get_history(ai_chat.id)['messages']
+        self.assertEqual(messages[0]['content'], 'New prompt')
+        self.assertEqual(messages[1:], [
+            {'role': 'user', 'content': 'Hello AI'},
+            {'role': 'assistant', 'content': 'AI response'},
+        ])
+    
+    @patch('ai_chat.views.get_async_openai_client')
+    def test_send_message_streams_server_sent_events(self, mock_get_client):
+        """Test streaming a reply from send_message as server-sent events"""
+        async def stream():
+            yield Mock(choices=[Mock(delta=Mock(content='AI '), finish_reason=None)], usage=None)
+            yield Mock(choices=[Mock(delta=Mock(content='response'), finish_reason='stop')], usage=None)
+            yield Mock(choices=[], usage=Mock(prompt_tokens=10, completion_tokens=20, total_tokens=30))
+        
+        mock_client = Mock()
+        mock_client.chat.completions.create = AsyncMock(return_value=stream())
+        mock_get_client.return_value = mock_client
+        
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        
+        data = {'content': 'Hello AI', 'stream': True}
+        response = self.client.post(f'/api/ai/chats/{ai_chat.id}/send_message/', data)
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [
+            json.loads(event[len('data: '):])
+            for event in b''.join(response).decode().split('\n\n') if event
+        ]
+        self.assertEqual([event['type'] for event in events], ['assistant_delta', 'assistant_delta', 'assistant_done'])
+        self.assertEqual(events[-1]['message']['content'], 'AI response')
+        self.assertEqual(events[-1]['message']['total_tokens'], 30)
+        self.assertEqual(ai_chat.messages.count(), 2)
+    
+    @patch('ai_chat.views.get_async_openai_client')
+    def test_send_message_stream_cut_off_not_saved(self, mock_get_client):
+        """Test that a streamed reply cut off before it finished gives an error and saves nothing"""
+        async def stream():
+            yield Mock(choices=[Mock(delta=Mock(content='AI '), finish_reason=None)], usage=None)
+            yield Mock(choices=[Mock(delta=Mock(content=None), finish_reason='length')], usage=None)
+        
+        mock_client = Mock()
+        mock_client.chat.completions.create = AsyncMock(return_value=stream())
+        mock_get_client.return_value = mock_client
+        
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        
+        data = {'content': 'Hello AI', 'stream': True}
+        response = self.client.post(f'/api/ai/chats/{ai_chat.id}/send_message/', data)
+        
+        events = [
+            json.loads(event[len('data: '):])
+            for event in b''.join(response).decode().split('\n\n') if event
+        ]
+        self.assertEqual([event['type'] for event in events], ['assistant_delta', 'error'])
+        self.assertIn('length', events[-1]['message'])
+        self.assertEqual(ai_chat.messages.count(), 0)
+    
+    @patch('ai_chat.views.get_openai_client')
+    def test_send_message_with_related_chat_context(self, mock_get_client):
         """Test sending a message with related chat context"""
         # Mock OpenAI response
         mock_response = Mock()
@@ -318,7 +680,7 @@ class AIChatAPITest(APITestCase):
         mock_response.usage = Mock(prompt_tokens=50, completion_tokens=30, total_tokens=80)
         mock_client = Mock()
         mock_client.chat.completions.create.return_value = mock_response
-        mock_openai.return_value = mock_client
+        mock_get_client.return_value = mock_client
         
         ai_chat = AIChat.objects.create(
             user=self.user1,
@@ -353,6 +715,87 @@ class AIChatAPITest(APITestCase):
         
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
     
+    @patch('ai_chat.views.get_openai_client')
+    def test_send_message_while_reply_in_progress(self, mock_get_client):
+        """Test that a second message fails fast while a reply is being generated"""
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        cache.add(turn_lock_key(ai_chat.id), self.user1.id)
+        
+        data = {'content': 'Hello, ChatGPT!'}
+        response = self.client.post(f'/api/ai/chats/{ai_chat.id}/send_message/', data)
+        
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        mock_get_client.assert_not_called()
+        self.assertFalse(AIMessage.objects.filter(ai_chat=ai_chat).exists())
+    
+    @patch('ai_chat.views.get_async_openai_client')
+    def test_send_message_stream_while_reply_in_progress(self, mock_get_client):
+        """Test that a streamed send reports a reply in progress as an error event"""
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        cache.add(turn_lock_key(ai_chat.id), 'other')
+        
+        data = {'content': 'Hello AI', 'stream': True}
+        response = self.client.post(f'/api/ai/chats/{ai_chat.id}/send_message/', data)
+        
+        events = [
+            json.loads(event[len('data: '):])
+            for event in b''.join(response).decode().split('\n\n') if event
+        ]
+        self.assertEqual([event['type'] for event in events], ['error'])
+        mock_get_client.assert_not_called()
+        self.assertEqual(cache.get(turn_lock_key(ai_chat.id)), 'other')
+        cache.delete(turn_lock_key(ai_chat.id))
+    
+    @patch('ai_chat.views.REPLY_TIMEOUT', -1)
+    @patch('ai_chat.views.get_async_openai_client')
+    def test_send_message_stream_abandoned_after_reply_timeout(self, mock_get_client):
+        """Test that a streamed reply running past REPLY_TIMEOUT is abandoned, unsaved and unlocked"""
+        async def stream():
+            yield Mock(choices=[Mock(delta=Mock(content='AI response'), finish_reason='stop')], usage=None)
+        
+        mock_client = Mock()
+        mock_client.chat.completions.create = AsyncMock(return_value=stream())
+        mock_get_client.return_value = mock_client
+        
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        
+        data = {'content': 'Hello AI', 'stream': True}
+        response = self.client.post(f'/api/ai/chats/{ai_chat.id}/send_message/', data)
+        
+        events = [
+            json.loads(event[len('data: '):])
+            for event in b''.join(response).decode().split('\n\n') if event
+        ]
+        self.assertEqual([event['type'] for event in events], ['error'])
+        self.assertIn('too long', events[0]['message'])
+        self.assertEqual(ai_chat.messages.count(), 0)
+        self.assertIsNone(cache.get(turn_lock_key(ai_chat.id)))
+    
+    @patch('ai_chat.views.get_openai_client')
+    def test_send_message_keeps_lock_taken_over_by_next_turn(self, mock_get_client):
+        """Test that a turn outliving its lock does not release the lock of the next turn"""
+        ai_chat = AIChat.objects.create(user=self.user1, title='Test Chat')
+        lock_key = turn_lock_key(ai_chat.id)
+        
+        def create(**kwargs):
+            # The lock expires mid-turn and another turn takes it
+            cache.set(lock_key, 'next-turn')
+            return Mock(
+                choices=[Mock(message=Mock(content='AI response'))],
+                usage=Mock(prompt_tokens=10, completion_tokens=20, total_tokens=30)
+            )
+        
+        mock_client = Mock()
+        mock_client.chat.completions.create.side_effect = create
+        mock_get_client.return_value = mock_client
+        
+        data = {'content': 'Hello, ChatGPT!'}
+        response = self.client.post(f'/api/ai/chats/{ai_chat.id}/send_message/', data)
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(cache.get(lock_key), 'next-turn')
+        cache.delete(lock_key)
+    
     def test_unauthenticated_access(self):
         """Test that unauthenticated users cannot access endpoints"""
         self.client.force_authenticate(user=None)
@@ -401,29 +844,38 @@ class AIMessageAPITest(APITestCase):
 # WEBSOCKET TESTS (Integration Tests)
 # =============================================================================
 
-class AIChatWebSocketTest(TransactionTestCase):
+class AIChatWebSocketTest(TestCase):
     """Integration tests for AI Chat WebSocket consumer"""
     
-    def setUp(self):
+    @classmethod
+    def setUpTestData(cls):
         """Setup for WebSocket tests"""
-        self.user = User.objects.create_user(
+        cls.user = User.objects.create_user(
             username='testuser',
             email='test@example.com',
             password='testpass123'
         )
-        self.ai_chat = AIChat.objects.create(
-            user=self.user,
+        cls.ai_chat = AIChat.objects.create(
+            user=cls.user,
             title='WebSocket Test Chat'
         )
     
-    async def test_websocket_connect_authenticated(self):
-        """Test WebSocket connection with authenticated user"""
+    def setUp(self):
+        cache.clear()
+    
+    def make_communicator(self, user=None):
+        """Build a communicator for the test AI chat, authenticated as user (default: self.user)"""
         communicator = WebsocketCommunicator(
             AIChatConsumer.as_asgi(),
             f'/ws/ai-chat/{self.ai_chat.id}/'
         )
-        communicator.scope['user'] = self.user
+        communicator.scope['user'] = user or self.user
         communicator.scope['url_route'] = {'kwargs': {'ai_chat_id': str(self.ai_chat.id)}}
+        return communicator
+    
+    async def test_websocket_connect_authenticated(self):
+        """Test WebSocket connection with authenticated user"""
+        communicator = self.make_communicator()
         
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
@@ -434,33 +886,50 @@ class AIChatWebSocketTest(TransactionTestCase):
         """Test WebSocket connection without authentication"""
         from django.contrib.auth.models import AnonymousUser
         
-        communicator = WebsocketCommunicator(
-            AIChatConsumer.as_asgi(),
-            f'/ws/ai-chat/{self.ai_chat.id}/'
-        )
-        communicator.scope['user'] = AnonymousUser()
-        communicator.scope['url_route'] = {'kwargs': {'ai_chat_id': str(self.ai_chat.id)}}
+        communicator = self.make_communicator(AnonymousUser())
         
         connected, _ = await communicator.connect()
         self.assertFalse(connected)
     
-    @patch('ai_chat.consumers.OpenAI')
-    async def test_websocket_send_message(self, mock_openai):
-        """Test sending a message through WebSocket"""
-        # Mock OpenAI response
-        mock_response = Mock()
-        mock_response.choices = [Mock(message=Mock(content='WebSocket AI response'))]
-        mock_response.usage = Mock(prompt_tokens=10, completion_tokens=20, total_tokens=30)
-        mock_client = Mock()
-        mock_client.chat.completions.create.return_value = mock_response
-        mock_openai.return_value = mock_client
+    async def test_websocket_connect_other_users_chat(self):
+        """Test WebSocket connection to another user's AI chat"""
+        other_user = await database_sync_to_async(User.objects.create_user)(
+            username='otheruser',
+            password='testpass123'
+        )
         
-        communicator = WebsocketCommunicator(
-            AIChatConsumer.as_asgi(),
-            f'/ws/ai-chat/{self.ai_chat.id}/'
+        for user, expected in ((self.user, True), (other_user, False)):
+            communicator = self.make_communicator(user)
+            
+            connected, _ = await communicator.connect()
+            self.assertEqual(connected, expected)
+            await communicator.disconnect()
+    
+    async def test_websocket_closed_when_ai_chat_deleted(self):
+        """Test that open sockets are closed when their AI chat is deleted"""
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        def delete_chat():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ai_chat.delete()
+        await database_sync_to_async(delete_chat)()
+        
+        output = await communicator.receive_output()
+        self.assertEqual(output['type'], 'websocket.close')
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_send_message(self, mock_stream_response):
+        """Test sending a message through WebSocket"""
+        # Mock OpenAI streaming response
+        mock_stream_response.return_value = make_stream(
+            'WebSocket ', 'AI response',
+            usage=Mock(input_tokens=10, output_tokens=20, total_tokens=30)
         )
-        communicator.scope['user'] = self.user
-        communicator.scope['url_route'] = {'kwargs': {'ai_chat_id': str(self.ai_chat.id)}}
+        
+        communicator = self.make_communicator()
         
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
@@ -477,21 +946,310 @@ class AIChatWebSocketTest(TransactionTestCase):
         self.assertEqual(response1['type'], 'user_message')
         self.assertEqual(response1['message']['content'], 'Hello via WebSocket')
         
-        # Receive assistant response
+        # Receive streamed deltas, coalesced into one frame
+        delta = await communicator.receive_json_from()
+        self.assertEqual(delta, {'type': 'assistant_delta', 'content': 'WebSocket AI response'})
+        
+        # Receive the completed assistant message
         response2 = await communicator.receive_json_from()
-        self.assertEqual(response2['type'], 'assistant_message')
+        self.assertEqual(response2['type'], 'assistant_done')
         self.assertEqual(response2['message']['content'], 'WebSocket AI response')
+        self.assertEqual(response2['message']['usage']['total_tokens'], 30)
+        
+        await communicator.disconnect()
+        
+        # Both messages are saved and the response id is kept
+        roles = await database_sync_to_async(list)(
+            self.ai_chat.messages.values_list('role', flat=True)
+        )
+        self.assertEqual(roles, ['user', 'assistant'])
+        await database_sync_to_async(self.ai_chat.refresh_from_db)()
+        self.assertEqual(self.ai_chat.previous_response_id, 'resp_1')
+        self.assertEqual(self.ai_chat.message_count, 2)
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_keeps_change_made_during_reply(self, mock_stream_response):
+        """Test that a system prompt changed while a reply streams is not overwritten by the turn"""
+        def change_prompt():
+            changed = AIChat.objects.get(pk=self.ai_chat.pk)
+            changed.system_prompt = 'New prompt'
+            with self.captureOnCommitCallbacks(execute=True):
+                changed.save()
+        
+        async def stream(**kwargs):
+            await database_sync_to_async(change_prompt)()
+            return make_stream('AI response')
+        
+        mock_stream_response.side_effect = stream
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        await communicator.send_json_to({'type': 'message', 'content': 'Hello'})
+        while (await communicator.receive_json_from())['type'] != 'assistant_done':
+            pass
+        await communicator.disconnect()
+        
+        history = await database_sync_to_async(get_history)(self.ai_chat.id)
+        self.assertEqual(history['messages'][0]['content'], 'New prompt')
+        self.assertEqual(len(history['messages']), 3)
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_failed_response_not_saved(self, mock_stream_response):
+        """Test that a failed or incomplete reply gives an error and saves nothing"""
+        async def failed_stream():
+            yield Mock(type='response.output_text.delta', delta='Partial')
+            yield Mock(type='response.failed', response=Mock(id='resp_failed', error=Mock(message='Server error')))
+        
+        async def incomplete_stream():
+            yield Mock(type='response.output_text.delta', delta='Partial')
+            yield Mock(type='response.incomplete', response=Mock(
+                id='resp_incomplete',
+                incomplete_details=Mock(reason='max_output_tokens')
+            ))
+        
+        for stream, message in ((failed_stream, 'Server error'), (incomplete_stream, 'max_output_tokens')):
+            mock_stream_response.return_value = stream()
+            communicator = self.make_communicator()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            
+            await communicator.send_json_to({'type': 'message', 'content': 'Hello'})
+            
+            self.assertEqual((await communicator.receive_json_from())['type'], 'user_message')
+            error = await communicator.receive_json_from()
+            self.assertEqual(error['type'], 'error')
+            self.assertIn(message, error['message'])
+            
+            await communicator.disconnect()
+        
+        self.assertEqual(await AIMessage.objects.filter(ai_chat=self.ai_chat).acount(), 0)
+        await self.ai_chat.arefresh_from_db()
+        self.assertIsNone(self.ai_chat.previous_response_id)
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_flushes_long_deltas(self, mock_stream_response):
+        """Test that buffered deltas are flushed once enough text has accumulated"""
+        mock_stream_response.return_value = make_stream('a' * 40, 'b' * 40, 'c')
+        
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        await communicator.send_json_to({'type': 'message', 'content': 'Hello'})
+        await communicator.receive_json_from()  # user_message
+        delta1 = await communicator.receive_json_from()
+        delta2 = await communicator.receive_json_from()
+        self.assertEqual(delta1['content'], 'a' * 40 + 'b' * 40)
+        self.assertEqual(delta2['content'], 'c')
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['message']['content'], 'a' * 40 + 'b' * 40 + 'c')
+        
+        await communicator.disconnect()
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_broadcasts_to_other_tabs(self, mock_stream_response):
+        """Test that a second socket on the same AI chat receives the streamed reply"""
+        mock_stream_response.return_value = make_stream('Shared reply')
+        
+        communicators = []
+        for _ in range(2):
+            communicator = self.make_communicator()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            communicators.append(communicator)
+        sender, other = communicators
+        
+        await sender.send_json_to({'type': 'message', 'content': 'Hello'})
+        
+        for communicator in (sender, other):
+            types = [(await communicator.receive_json_from())['type'] for _ in range(3)]
+            self.assertEqual(types, ['user_message', 'assistant_delta', 'assistant_done'])
+        self.assertTrue(await sender.receive_nothing())
+        
+        for communicator in communicators:
+            await communicator.disconnect()
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_send_message_with_related_chat_context(self, mock_stream_response):
+        """Test that related chat context and history are sent to OpenAI"""
+        mock_stream_response.return_value = make_stream('Summary')
+        
+        chat = await database_sync_to_async(Chat.objects.create)(name='Related Chat')
+        await database_sync_to_async(Message.objects.create)(
+            chat=chat, sender=self.user, content='Earlier discussion'
+        )
+        self.ai_chat.related_chat = chat
+        await database_sync_to_async(self.ai_chat.save)()
+        
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        await communicator.send_json_to({
+            'type': 'message',
+            'content': 'Summarize',
+            'include_related_chat_context': True
+        })
+        
+        await communicator.receive_json_from()  # user_message
+        await communicator.receive_json_from()  # assistant_delta
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'assistant_done')
+        
+        kwargs = mock_stream_response.call_args[1]
+        self.assertIn('testuser: Earlier discussion', kwargs['instructions'])
+        self.assertEqual(kwargs['input'], [{'role': 'user', 'content': 'Summarize'}])
+        
+        await communicator.disconnect()
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_continues_previous_response(self, mock_stream_response):
+        """Test that later turns send only the new message and the previous response id"""
+        responses = iter(['resp_1', 'resp_2'])
+        mock_stream_response.side_effect = lambda **kwargs: make_stream(
+            'Reply', response_id=next(responses)
+        )
+        
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        for content in ('First', 'Second'):
+            await communicator.send_json_to({'type': 'message', 'content': content})
+            for _ in range(3):  # user_message, assistant_delta, assistant_done
+                await communicator.receive_json_from()
+        
+        first, second = mock_stream_response.call_args_list
+        self.assertNotIn('previous_response_id', first[1])
+        self.assertEqual(second[1]['previous_response_id'], 'resp_1')
+        self.assertEqual(second[1]['input'], [{'role': 'user', 'content': 'Second'}])
+        
+        await communicator.disconnect()
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_falls_back_to_full_history(self, mock_stream_response):
+        """Test that an expired previous response falls back to sending the full history"""
+        await database_sync_to_async(AIMessage.objects.create)(
+            ai_chat=self.ai_chat, role='user', content='Earlier question'
+        )
+        await database_sync_to_async(AIMessage.objects.create)(
+            ai_chat=self.ai_chat, role='assistant', content='Earlier answer'
+        )
+        self.ai_chat.previous_response_id = 'resp_expired'
+        await database_sync_to_async(self.ai_chat.save)()
+        
+        not_found = BadRequestError(
+            'Previous response not found',
+            response=httpx.Response(400, request=httpx.Request('POST', 'https://api.openai.com')),
+            body={'param': 'previous_response_id'}
+        )
+        mock_stream_response.side_effect = [not_found, make_stream('Reply')]
+        
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        await communicator.send_json_to({'type': 'message', 'content': 'New question'})
+        await communicator.receive_json_from()  # user_message
+        await communicator.receive_json_from()  # assistant_delta
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'assistant_done')
+        
+        retry = mock_stream_response.call_args[1]
+        self.assertNotIn('previous_response_id', retry)
+        self.assertEqual(retry['input'], [
+            {'role': 'user', 'content': 'Earlier question'},
+            {'role': 'assistant', 'content': 'Earlier answer'},
+            {'role': 'user', 'content': 'New question'},
+        ])
+        
+        await communicator.disconnect()
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_trims_history_to_context_window(self, mock_stream_response):
+        """Test that the oldest turns are dropped when the history outgrows the context window"""
+        await database_sync_to_async(AIMessage.objects.create)(
+            ai_chat=self.ai_chat, role='user', content='x' * 400
+        )
+        await database_sync_to_async(AIMessage.objects.create)(
+            ai_chat=self.ai_chat, role='assistant', content='Short answer', completion_tokens=3
+        )
+        mock_stream_response.return_value = make_stream('Reply')
+        
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        budget = self.ai_chat.system_prompt_tokens + count_tokens('New question') + 10
+        with self.settings(OPENAI_CONTEXT_TOKENS=budget, OPENAI_RESPONSE_TOKENS=0):
+            await communicator.send_json_to({'type': 'message', 'content': 'New question'})
+            for _ in range(3):  # user_message, assistant_delta, assistant_done
+                await communicator.receive_json_from()
+        
+        self.assertEqual(mock_stream_response.call_args[1]['input'], [
+            {'role': 'assistant', 'content': 'Short answer'},
+            {'role': 'user', 'content': 'New question'},
+        ])
+        
+        await communicator.disconnect()
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_replayed_message_reuses_reply(self, mock_stream_response):
+        """Test that resending a just-answered message returns the saved reply without calling OpenAI"""
+        mock_stream_response.side_effect = lambda **kwargs: make_stream('Reply')
+        
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        await communicator.send_json_to({'type': 'message', 'content': 'Hello'})
+        for _ in range(2):  # user_message, assistant_delta
+            await communicator.receive_json_from()
+        first = await communicator.receive_json_from()
+        
+        await communicator.send_json_to({'type': 'message', 'content': 'Hello'})
+        replay = await communicator.receive_json_from()
+        self.assertEqual(replay['type'], 'assistant_done')
+        self.assertEqual(replay['message']['id'], first['message']['id'])
+        self.assertEqual(mock_stream_response.call_count, 1)
+        
+        count = await database_sync_to_async(AIMessage.objects.filter(ai_chat=self.ai_chat).count)()
+        self.assertEqual(count, 2)
+        
+        await communicator.disconnect()
+    
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_earlier_message_not_replayed(self, mock_stream_response):
+        """Test that repeating a message from before the last turn gets a new reply"""
+        mock_stream_response.side_effect = lambda **kwargs: make_stream('Reply')
+        
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        for content in ('yes', 'no', 'yes'):
+            await communicator.send_json_to({'type': 'message', 'content': content})
+            for _ in range(3):  # user_message, assistant_delta, assistant_done
+                await communicator.receive_json_from()
+        
+        self.assertEqual(mock_stream_response.call_count, 3)
+        count = await database_sync_to_async(AIMessage.objects.filter(ai_chat=self.ai_chat).count)()
+        self.assertEqual(count, 6)
         
         await communicator.disconnect()
     
     async def test_websocket_send_empty_message(self):
         """Test sending an empty message through WebSocket"""
-        communicator = WebsocketCommunicator(
-            AIChatConsumer.as_asgi(),
-            f'/ws/ai-chat/{self.ai_chat.id}/'
-        )
-        communicator.scope['user'] = self.user
-        communicator.scope['url_route'] = {'kwargs': {'ai_chat_id': str(self.ai_chat.id)}}
+        communicator = self.make_communicator()
         
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
@@ -508,14 +1266,29 @@ class AIChatWebSocketTest(TransactionTestCase):
         
         await communicator.disconnect()
     
+    @patch('ai_chat.consumers.stream_response', new_callable=AsyncMock)
+    async def test_websocket_send_message_while_reply_in_progress(self, mock_stream_response):
+        """Test that a message sent while another reply is generated gets an error"""
+        await cache.aadd(turn_lock_key(self.ai_chat.id), 'other')
+        communicator = self.make_communicator()
+        
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        
+        await communicator.send_json_to({
+            'type': 'message',
+            'content': 'Hello!',
+        })
+        
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        mock_stream_response.assert_not_called()
+        
+        await communicator.disconnect()
+    
     async def test_websocket_invalid_json(self):
         """Test sending invalid JSON through WebSocket"""
-        communicator = WebsocketCommunicator(
-            AIChatConsumer.as_asgi(),
-            f'/ws/ai-chat/{self.ai_chat.id}/'
-        )
-        communicator.scope['user'] = self.user
-        communicator.scope['url_route'] = {'kwargs': {'ai_chat_id': str(self.ai_chat.id)}}
+        communicator = self.make_communicator()
         
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
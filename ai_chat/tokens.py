@@ -0,0 +1,44 @@
+"""
+Token counting for OpenAI prompts and trimming history to the model's context window.
+"""
+from functools import lru_cache
+
+import tiktoken
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    """
+    Load the tiktoken encoding for a model, or None if it is unavailable.
+    The first call may download the encoding, so call this off the event loop.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('o200k_base')
+    except Exception:
+        # Encodings are downloaded on first use and may be unreachable
+        return None
+
+
+def count_tokens(text):
+    """
+    Count the tokens text takes up for the configured OpenAI model.
+    Falls back to roughly four characters per token if the encoding cannot be loaded.
+    """
+    encoding = _get_encoding(settings.OPENAI_MODEL)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def fit_history(messages, message_tokens, budget):
+    """Return the most recent messages whose token counts add up to at most budget"""
+    total = 0
+    start = len(messages)
+    while start > 0 and total + message_tokens[start - 1] <= budget:
+        start -= 1
+        total += message_tokens[start]
+    return messages[start:]
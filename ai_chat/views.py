@@ -1,15 +1,32 @@
-import os
+import time
+import orjson
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Max, Prefetch
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from drf_spectacular.utils import extend_schema, extend_schema_view, OpenApiParameter
-from openai import OpenAI
 
+from .cache import (
+    RESPONSE_CACHE_TIMEOUT,
+    aacquire_turn_lock,
+    acquire_turn_lock,
+    arelease_turn_lock,
+    messages_response_cache_key,
+    related_context_cache_key,
+    release_turn_lock
+)
+from .clients import REPLY_TIMEOUT, IncompleteResponseError, get_async_openai_client, get_openai_client
+from .history import extend_history, get_history, save_history
 from .models import AIChat, AIMessage
 from .serializers import (
     AIChatSerializer,
+    AIChatDetailSerializer,
     AIChatCreateSerializer,
     AIMessageSerializer,
     SendAIMessageSerializer,
@@ -17,11 +34,22 @@ from .serializers import (
 )
 from chat.models import Message
 
+TURN_IN_PROGRESS_ERROR = 'A reply is already being generated for this chat'
+
 
 @extend_schema_view(
     list=extend_schema(
         summary="List AI chats",
-        description="Get all AI chats for the authenticated user",
+        description="Get all AI chats for the authenticated user. Pass include=messages to embed each chat's messages.",
+        parameters=[
+            OpenApiParameter(
+                name='include',
+                type=str,
+                location=OpenApiParameter.QUERY,
+                description='Set to "messages" to include the messages of each chat',
+                enum=['messages']
+            )
+        ],
         tags=['AI Chat']
     ),
     create=extend_schema(
@@ -48,25 +76,51 @@ class AIChatViewSet(viewsets.ModelViewSet):
     """
     permission_classes = [IsAuthenticated]
     
+    # Columns rendered by AIChatSerializer, loaded with the user and related chat
+    READ_FIELDS = [
+        'id', 'user__username', 'related_chat__name', 'title',
+        'system_prompt', 'created_at', 'updated_at', 'message_count'
+    ]
+    MESSAGE_FIELDS = [
+        'id', 'ai_chat_id', 'role', 'content', 'timestamp',
+        'prompt_tokens', 'completion_tokens', 'total_tokens'
+    ]
+    
     def get_queryset(self):
         """Return only the authenticated user's AI chats"""
-        return AIChat.objects.filter(user=self.request.user).prefetch_related('messages')
+        queryset = AIChat.objects.filter(user=self.request.user)
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.select_related('user', 'related_chat').only(*self.READ_FIELDS)
+        if self._include_messages():
+            queryset = queryset.prefetch_related(Prefetch(
+                'messages',
+                queryset=AIMessage.objects.only(*self.MESSAGE_FIELDS).order_by('id')
+            ))
+        return queryset
     
     def get_serializer_class(self):
         """Use different serializers for different actions"""
         if self.action == 'create':
             return AIChatCreateSerializer
+        if self._include_messages():
+            return AIChatDetailSerializer
         return AIChatSerializer
     
+    def _include_messages(self):
+        """Messages are embedded on retrieve, or on list when include=messages is passed"""
+        if self.action == 'retrieve':
+            return True
+        return self.action == 'list' and self.request.query_params.get('include') == 'messages'
+    
     def perform_create(self, serializer):
         """Set the user when creating an AI chat"""
         serializer.save(user=self.request.user)
     
     @extend_schema(
         summary="Send message to ChatGPT",
-        description="Send a message to ChatGPT and get a response. Optionally include related chat history as context.",
+        description="Send a message to ChatGPT and get a response. Optionally include related chat history as context. With stream=true the reply is sent as server-sent events (assistant_delta, then assistant_done or error), and a reply already in progress is reported as an error event instead of a 409.",
         request=SendAIMessageSerializer,
-        responses={200: AIMessageSerializer},
+        responses={200: AIMessageSerializer, 409: None},
         tags=['AI Chat']
     )
     @action(detail=True, methods=['post'])
@@ -85,48 +139,161 @@ class AIChatViewSet(viewsets.ModelViewSet):
         include_context = serializer.validated_data['include_related_chat_context']
         context_limit = serializer.validated_data['context_message_limit']
         
-        # Save user message
-        user_message = AIMessage.objects.create(
-            ai_chat=ai_chat,
-            role='user',
-            content=content
-        )
+        if serializer.validated_data['stream']:
+            # The stream takes the turn lock itself, so a response that is never read holds nothing
+            response = StreamingHttpResponse(
+                self._stream_reply(ai_chat, content, include_context, context_limit),
+                content_type='text/event-stream'
+            )
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        
+        # One reply at a time per chat; a concurrent request fails fast instead of
+        # generating a second reply from the same history
+        lock_token = acquire_turn_lock(ai_chat.id)
+        if lock_token is None:
+            return Response(
+                {'error': TURN_IN_PROGRESS_ERROR},
+                status=status.HTTP_409_CONFLICT
+            )
         
         try:
             # Prepare messages for OpenAI API
-            messages = self._prepare_messages(ai_chat, include_context, context_limit)
+            history = get_history(ai_chat.id)
+            messages = self._prepare_messages(ai_chat, history, content, include_context, context_limit)
             
-            # Call OpenAI API
-            client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-            response = client.chat.completions.create(
-                model=os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo'),
-                messages=messages
+            try:
+                # Call OpenAI API
+                client = get_openai_client()
+                response = client.chat.completions.create(
+                    model=settings.OPENAI_MODEL,
+                    messages=messages
+                )
+                
+                # Extract response
+                assistant_content = response.choices[0].message.content
+                assistant_message = self._save_pair(ai_chat, history, content, assistant_content, response.usage)
+                
+                return Response(
+                    AIMessageSerializer(assistant_message).data,
+                    status=status.HTTP_200_OK
+                )
+                
+            except Exception as e:
+                return Response(
+                    {'error': f'Failed to get response from ChatGPT: {str(e)}'},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+        finally:
+            release_turn_lock(ai_chat.id, lock_token)
+    
+    async def _stream_reply(self, ai_chat, content, include_context, context_limit):
+        """
+        Yield the reply as server-sent events: assistant_delta events while it is
+        generated, then assistant_done with the saved message.
+        Under ASGI the response is served from the event loop, so the OpenAI round trip
+        does not hold a worker thread.
+        """
+        lock_token = await aacquire_turn_lock(ai_chat.id)
+        if lock_token is None:
+            yield self._sse({'type': 'error', 'message': TURN_IN_PROGRESS_ERROR})
+            return
+        
+        try:
+            history = await sync_to_async(get_history)(ai_chat.id)
+            messages = await sync_to_async(self._prepare_messages)(
+                ai_chat, history, content, include_context, context_limit
             )
-            
-            # Extract response
-            assistant_content = response.choices[0].message.content
-            usage = response.usage
-            
-            # Save assistant message
-            assistant_message = AIMessage.objects.create(
-                ai_chat=ai_chat,
-                role='assistant',
-                content=assistant_content,
-                prompt_tokens=usage.prompt_tokens,
-                completion_tokens=usage.completion_tokens,
-                total_tokens=usage.total_tokens
+            deadline = time.monotonic() + REPLY_TIMEOUT
+            stream = await get_async_openai_client().chat.completions.create(
+                model=settings.OPENAI_MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True}
             )
+            parts = []
+            usage = None
+            finish_reason = None
+            async for chunk in stream:
+                # Give up on a reply that would outlive the turn lock
+                if time.monotonic() > deadline:
+                    raise IncompleteResponseError('The response took too long')
+                # The final chunk carries usage and no choices
+                if chunk.choices:
+                    choice = chunk.choices[0]
+                    if choice.delta.content:
+                        parts.append(choice.delta.content)
+                        yield self._sse({'type': 'assistant_delta', 'content': choice.delta.content})
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+                if chunk.usage:
+                    usage = chunk.usage
             
-            return Response(
-                AIMessageSerializer(assistant_message).data,
-                status=status.HTTP_200_OK
-            )
+            # A reply cut off (length, content_filter) or a stream that ended early is not saved
+            if finish_reason != 'stop':
+                raise IncompleteResponseError(
+                    f'The response is incomplete: {finish_reason or "the stream ended early"}'
+                )
             
+            assistant_message = await sync_to_async(self._save_pair)(
+                ai_chat, history, content, ''.join(parts), usage
+            )
+            yield self._sse({
+                'type': 'assistant_done',
+                'message': AIMessageSerializer(assistant_message).data
+            })
         except Exception as e:
-            return Response(
-                {'error': f'Failed to get response from ChatGPT: {str(e)}'},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            yield self._sse({
+                'type': 'error',
+                'message': f'Failed to get response from ChatGPT: {str(e)}'
+            })
+        finally:
+            await arelease_turn_lock(ai_chat.id, lock_token)
+    
+    @staticmethod
+    def _sse(payload):
+        """Format a payload as a server-sent event"""
+        return b'data: ' + orjson.dumps(payload) + b'\n\n'
+    
+    def _save_pair(self, ai_chat, history, content, assistant_content, usage):
+        """
+        Save the user message and the assistant reply in a single INSERT.
+        Returns the assistant message.
+        """
+        with transaction.atomic():
+            assistant_message = AIMessage.objects.bulk_create([
+                AIMessage(
+                    ai_chat=ai_chat,
+                    role='user',
+                    content=content,
+                    content_sha=AIMessage.content_digest(content)
+                ),
+                AIMessage(
+                    ai_chat=ai_chat,
+                    role='assistant',
+                    content=assistant_content,
+                    prompt_tokens=usage.prompt_tokens if usage else None,
+                    completion_tokens=usage.completion_tokens if usage else None,
+                    total_tokens=usage.total_tokens if usage else None
+                )
+            ])[1]
+            # bulk_create skips the signals that keep message_count in sync.
+            # This turn is also not part of the stored OpenAI response chain.
+            AIChat.objects.filter(pk=ai_chat.pk).update(
+                previous_response_id=None,
+                message_count=F('message_count') + 2
             )
+        # Extend the cached history with this turn, outside the response chain,
+        # unless the chat changed since the history was read
+        save_history(ai_chat.pk, extend_history(
+            history,
+            content,
+            assistant_content,
+            usage.completion_tokens if usage else None,
+            None
+        ))
+        return assistant_message
     
     @extend_schema(
         summary="Get messages",
@@ -138,9 +305,13 @@ class AIChatViewSet(viewsets.ModelViewSet):
     def messages(self, request, pk=None):
         """Get all messages in this AI chat"""
         ai_chat = self.get_object()
-        messages = ai_chat.messages.all()
-        serializer = AIMessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        last_message_id = ai_chat.messages.aggregate(last_id=Max('id'))['last_id']
+        key = messages_response_cache_key(ai_chat.id, last_message_id, ai_chat.message_count)
+        data = cache.get(key)
+        if data is None:
+            data = AIMessageSerializer(ai_chat.messages.all(), many=True).data
+            cache.set(key, data, RESPONSE_CACHE_TIMEOUT)
+        return Response(data)
     
     @extend_schema(
         summary="Get related chat context",
@@ -173,20 +344,28 @@ class AIChatViewSet(viewsets.ModelViewSet):
         
         limit = serializer.validated_data['message_limit']
         
-        # Get recent messages from related chat
-        messages = Message.objects.filter(
-            chat=ai_chat.related_chat
-        ).select_related('sender').order_by('-timestamp')[:limit]
-        
-        # Format messages for context
-        context_messages = [
-            {
-                'sender': msg.sender.username,
-                'content': msg.content,
-                'timestamp': msg.timestamp.isoformat()
-            }
-            for msg in reversed(messages)
-        ]
+        # Reuse the formatted messages until a new one is posted to the related chat
+        last_message_id = Message.objects.filter(
+            chat_id=ai_chat.related_chat_id
+        ).aggregate(last_id=Max('id'))['last_id']
+        key = related_context_cache_key(ai_chat.related_chat_id, last_message_id, limit)
+        context_messages = cache.get(key)
+        if context_messages is None:
+            # Get recent messages from related chat
+            messages = self._latest_related_messages(ai_chat, limit).values_list(
+                'sender_username', 'content', 'timestamp'
+            )
+            
+            # Format messages for context
+            context_messages = [
+                {
+                    'sender': username,
+                    'content': content,
+                    'timestamp': timestamp.isoformat()
+                }
+                for username, content, timestamp in messages
+            ]
+            cache.set(key, context_messages, RESPONSE_CACHE_TIMEOUT)
         
         return Response({
             'chat_name': ai_chat.related_chat.name,
@@ -194,40 +373,43 @@ class AIChatViewSet(viewsets.ModelViewSet):
             'messages': context_messages
         })
     
-    def _prepare_messages(self, ai_chat, include_context, context_limit):
+    @staticmethod
+    def _latest_related_messages(ai_chat, limit):
+        """
+        Return the latest messages of the related chat in chronological order.
+        The database picks the latest ones and sorts them, so nothing is reversed in Python.
+        """
+        latest = Message.objects.filter(
+            chat_id=ai_chat.related_chat_id
+        ).order_by('-timestamp').values('pk')[:limit]
+        return Message.objects.filter(pk__in=latest).order_by('timestamp')
+    
+    def _prepare_messages(self, ai_chat, history, content, include_context, context_limit):
         """
         Prepare messages array for OpenAI API.
-        Includes system prompt, optional related chat context, and conversation history.
+        Includes system prompt, optional related chat context, conversation history
+        and the new user message, which is not saved yet.
         """
-        messages = []
-        
-        # Add system prompt
-        system_content = ai_chat.system_prompt
+        # The system message and prior turns are reused from the cache between sends
+        system_message = history['messages'][0]
         
         # Optionally add related chat context
-        if include_context and ai_chat.related_chat:
-            related_messages = Message.objects.filter(
-                chat=ai_chat.related_chat
-            ).select_related('sender').order_by('-timestamp')[:context_limit]
+        if include_context and ai_chat.related_chat_id:
+            related_messages = list(
+                self._latest_related_messages(ai_chat, context_limit)
+                .values_list('sender_username', 'content')
+            )
             
             if related_messages:
-                context_text = "\n\nContext from related chat:\n"
-                for msg in reversed(related_messages):
-                    context_text += f"{msg.sender.username}: {msg.content}\n"
-                system_content += context_text
-        
-        messages.append({
-            'role': 'system',
-            'content': system_content
-        })
+                parts = [system_message['content'], "\n\nContext from related chat:\n"]
+                parts.extend(
+                    f"{username}: {message_content}\n"
+                    for username, message_content in related_messages
+                )
+                system_message = {'role': 'system', 'content': "".join(parts)}
         
-        # Add conversation history
-        for msg in ai_chat.messages.all():
-            if msg.role in ['user', 'assistant']:
-                messages.append({
-                    'role': msg.role,
-                    'content': msg.content
-                })
+        messages = [system_message, *history['messages'][1:]]
+        messages.append({'role': 'user', 'content': content})
         
         return messages
 
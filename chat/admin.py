@@ -24,5 +24,6 @@ class ChatAdmin(admin.ModelAdmin):
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ['sender', 'chat', 'timestamp']
+    list_select_related = ['sender', 'chat']
     list_filter = ['chat', 'timestamp']
     readonly_fields = ['timestamp']
@@ -0,0 +1,10 @@
+"""
+Cache keys and timeouts shared by the chat views and signals.
+"""
+CURRENT_USER_CACHE_TIMEOUT = 300
+
+
+def current_user_cache_key(user_id):
+    """Key for the serialized profile returned by the current user endpoint"""
+    return f'chat:me:{user_id}'
+
@@ -1,19 +1,32 @@
-import json
+import asyncio
+import orjson
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from .models import Chat, Message
-from .serializers import MessageSerializer
+from .serializers import serialize_messages
 
 User = get_user_model()
 
+# Inbound messages are written and published in batches: a batch waits up to
+# this many seconds after its first message and holds at most this many messages
+BATCH_WINDOW = 0.02
+BATCH_SIZE = 32
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.room_group_name = f'chat_{self.chat_id}'
+        chat_id = self.scope['url_route']['kwargs']['chat_id']
+        self.room_group_name = f'chat_{chat_id}'
         self.user = self.scope['user']
 
+        # Saved messages are serialized from chat_id, so keep it an int like the model's
+        try:
+            self.chat_id = int(chat_id)
+        except ValueError:
+            await self.close()
+            return
+
         # Check if user is authenticated
         if not self.user.is_authenticated:
             await self.close()
@@ -33,7 +46,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
+        self._inbound = asyncio.Queue()
+        self._flush_task = asyncio.create_task(self.flush_inbound())
+
     async def disconnect(self, close_code):
+        # Write out messages still waiting in the batch, then stop the writer
+        flush_task = getattr(self, '_flush_task', None)
+        if flush_task is not None:
+            self._inbound.put_nowait(None)
+            await flush_task
+
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -43,73 +65,106 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def receive(self, text_data):
         """Receive message from WebSocket"""
         try:
-            data = json.loads(text_data)
+            data = orjson.loads(text_data)
             content = data.get('content', '')
 
             if not content:
-                await self.send(text_data=json.dumps({
+                await self.send(text_data=orjson.dumps({
                     'type': 'error',
                     'message': 'Content cannot be empty'
-                }))
+                }).decode())
                 return
 
-            # Save message to database
-            message = await self.save_message(content)
-
-            # Serialize the message
-            message_data = await self.serialize_message(message)
-
-            # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message_data
-                }
-            )
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            # Saved and sent to the room group with the rest of its batch
+            self._inbound.put_nowait(content)
+        except orjson.JSONDecodeError:
+            await self.send(text_data=orjson.dumps({
                 'type': 'error',
                 'message': 'Invalid JSON'
-            }))
+            }).decode())
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send(text_data=orjson.dumps({
                 'type': 'error',
                 'message': str(e)
-            }))
+            }).decode())
+
+    async def flush_inbound(self):
+        """
+        Save and publish inbound messages in batches, so a burst costs one INSERT
+        and one group message instead of one of each per message.
+        A None in the queue flushes what is pending and stops the writer.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            content = await self._inbound.get()
+            if content is None:
+                return
+            batch = [content]
+            stop = False
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    content = await asyncio.wait_for(self._inbound.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if content is None:
+                    stop = True
+                    break
+                batch.append(content)
+
+            try:
+                messages_data = await self.save_messages(batch)
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'chat_batch',
+                        'messages': messages_data
+                    }
+                )
+            except Exception as e:
+                await self.send(text_data=orjson.dumps({
+                    'type': 'error',
+                    'message': str(e)
+                }).decode())
+            if stop:
+                return
+
+    async def chat_batch(self, event):
+        """Receive a batch of messages from room group"""
+        # Clients still get one frame per message
+        for message in event['messages']:
+            await self.chat_message({'message': message})
 
     async def chat_message(self, event):
         """Receive message from room group"""
         message = event['message']
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=orjson.dumps({
             'type': 'message',
             'message': message
-        }))
+        }).decode())
 
     @database_sync_to_async
     def check_participant(self):
         """Check if user is a participant in the chat"""
-        try:
-            chat = Chat.objects.get(id=self.chat_id)
-            return chat.participants.filter(id=self.user.id).exists()
-        except Chat.DoesNotExist:
-            return False
+        return Chat.objects.filter(id=self.chat_id, participants=self.user).exists()
 
     @database_sync_to_async
-    def save_message(self, content):
-        """Save message to database"""
-        chat = Chat.objects.get(id=self.chat_id)
-        message = Message.objects.create(
-            chat=chat,
-            sender=self.user,
-            content=content
-        )
-        return message
-
-    @database_sync_to_async
-    def serialize_message(self, message):
-        """Serialize message using MessageSerializer"""
-        serializer = MessageSerializer(message)
-        return serializer.data
+    def save_messages(self, contents):
+        """Save a batch of messages with one INSERT and return them serialized"""
+        # Participation was checked on connect, so the chat is not loaded again.
+        # bulk_create skips Message.save(), so the sender's username is set here.
+        messages = Message.objects.bulk_create([
+            Message(
+                chat_id=self.chat_id,
+                sender=self.user,
+                sender_username=self.user.username,
+                content=content
+            )
+            for content in contents
+        ])
+        return serialize_messages(messages)
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-15 01:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_alter_chat_name_alter_chat_participants_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', '-timestamp'], name='chat_messag_chat_id_fa2313_idx'),
+        ),
+    ]
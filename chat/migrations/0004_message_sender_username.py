@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-15 03:05
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_sender_username(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    User = apps.get_model('chat', 'User')
+    usernames = User.objects.filter(pk=OuterRef('sender_id')).values('username')
+    Message.objects.update(sender_username=Subquery(usernames))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_add_message_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='sender_username',
+            field=models.CharField(default='', editable=False, help_text='Username of the sender, copied on save so history reads skip the user join', max_length=150),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_sender_username, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-15 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_sender_username'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'id'], name='chat_messag_chat_id_08e8ad_idx'),
+        ),
+    ]
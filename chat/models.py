@@ -31,11 +31,38 @@ class Chat(models.Model):
 class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages', help_text='The chat room this message belongs to')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages', help_text='User who sent the message')
+    sender_username = models.CharField(max_length=150, editable=False, help_text='Username of the sender, copied on save so history reads skip the user join')
     content = models.TextField(help_text='Message content')
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['chat', '-timestamp']),
+            models.Index(fields=['chat', 'id']),
+        ]
 
     def __str__(self):
         return f"{self.sender.username} in {self.chat.name} at {self.timestamp}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stored sender_username belongs to the sender as loaded
+        instance._saved_sender_id = instance.__dict__.get('sender_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Copy the username for a new message and whenever the sender is reassigned
+        update_fields = kwargs.get('update_fields')
+        copy_username = (
+            (update_fields is None or 'sender' in update_fields)
+            and self.sender_id != getattr(self, '_saved_sender_id', None)
+        )
+        if copy_username:
+            self.sender_username = self.sender.username
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'sender_username'}
+        super().save(*args, **kwargs)
+        if copy_username:
+            self._saved_sender_id = self.sender_id
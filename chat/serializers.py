@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from .models import Chat, Message
 
 User = get_user_model()
@@ -9,8 +10,9 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(
         write_only=True, 
         required=True, 
+        min_length=8,
         style={'input_type': 'password'},
-        help_text='Password for the new account (minimum 8 characters recommended)'
+        help_text='Password for the new account (minimum 8 characters)'
     )
     password_confirm = serializers.CharField(
         write_only=True, 
@@ -53,8 +55,14 @@ class UserListSerializer(serializers.ModelSerializer):
         fields = ['username', 'first_name', 'last_name']
 
 
+class MessageSenderSerializer(serializers.Serializer):
+    """Sender of a message, read from the message row so listing messages needs no user join"""
+    id = serializers.IntegerField(source='sender_id', read_only=True)
+    username = serializers.CharField(source='sender_username', read_only=True)
+
+
 class MessageSerializer(serializers.ModelSerializer):
-    sender = UserSerializer(read_only=True)
+    sender = MessageSenderSerializer(source='*', read_only=True)
 
     class Meta:
         model = Message
@@ -62,6 +70,35 @@ class MessageSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'chat', 'sender', 'timestamp']
 
 
+class MessageDetailSerializer(MessageSerializer):
+    """Single message with the sender's full profile"""
+    sender = UserSerializer(read_only=True)
+
+
+# Built once per process; to_representation only reads its field tree, so it can be shared
+_message_serializer = MessageSerializer()
+
+
+def serialize_messages(messages):
+    """Serialize messages like MessageSerializer(many=True) without rebuilding its fields per call"""
+    return [_message_serializer.to_representation(message) for message in messages]
+
+
+class MessagePageSerializer(serializers.Serializer):
+    """Query parameters for a page of chat messages"""
+    before_id = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        help_text='Return messages older than this message id (next_cursor of the previous page)'
+    )
+    limit = serializers.IntegerField(
+        default=50,
+        min_value=1,
+        max_value=200,
+        help_text='Number of messages to return'
+    )
+
+
 class ChatSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
     messages = MessageSerializer(many=True, read_only=True)
@@ -84,22 +121,28 @@ class ChatSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
     def create(self, validated_data):
-        participant_ids = validated_data.pop('participant_ids', [])
+        participant_ids = set(validated_data.pop('participant_ids', []))
         participant_usernames = validated_data.pop('participant_usernames', [])
-        chat = Chat.objects.create(**validated_data)
         
         # Add the creator to participants
         request = self.context.get('request')
         if request and request.user:
-            chat.participants.add(request.user)
-        
-        # Add participants by IDs
-        if participant_ids:
-            chat.participants.add(*participant_ids)
+            participant_ids.add(request.user.id)
         
         # Add participants by usernames (skip invalid ones)
         if participant_usernames:
-            valid_users = User.objects.filter(username__in=participant_usernames)
-            chat.participants.add(*valid_users)
+            participant_ids.update(
+                User.objects.filter(username__in=participant_usernames).values_list('id', flat=True)
+            )
+        
+        # Create the chat and all its participant rows in one transaction. The chat is new,
+        # so the rows are inserted directly instead of add() first looking for existing ones.
+        Participant = Chat.participants.through
+        with transaction.atomic():
+            chat = Chat.objects.create(**validated_data)
+            Participant.objects.bulk_create(
+                [Participant(chat_id=chat.id, user_id=user_id) for user_id in participant_ids],
+                ignore_conflicts=True
+            )
         
         return chat
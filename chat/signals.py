@@ -0,0 +1,25 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .cache import current_user_cache_key
+from .models import Message, User
+
+
+@receiver(post_save, sender=User)
+def sync_sender_username(sender, instance, created, update_fields=None, **kwargs):
+    """Keep the username copied onto a user's messages in sync when it changes"""
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+    Message.objects.filter(sender=instance).exclude(
+        sender_username=instance.username
+    ).update(sender_username=instance.username)
+
+
+@receiver(post_save, sender=User)
+def invalidate_current_user(sender, instance, created, **kwargs):
+    """Drop the cached current user profile once a change to the user is committed"""
+    if not created:
+        key = current_user_cache_key(instance.pk)
+        transaction.on_commit(lambda: cache.delete(key))
@@ -1,3 +1,309 @@
+from unittest.mock import patch
 from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from rest_framework.test import APITestCase
+from rest_framework import status
+from channels.testing import WebsocketCommunicator
 
-# Create your tests here.
+from .consumers import ChatConsumer
+from .models import Chat, Message
+from .throttling import LoginRateThrottle
+
+from myproject.renderers import ORJSONRenderer
+
+User = get_user_model()
+
+
+# =============================================================================
+# RENDERER TESTS (Unit Tests)
+# =============================================================================
+
+class ORJSONRendererTest(TestCase):
+    """Test cases for the orjson REST API renderer"""
+
+    def test_render_non_string_keys(self):
+        """Test that index-keyed error dicts are rendered with string keys"""
+        self.assertEqual(
+            ORJSONRenderer().render({'participant_ids': {0: ['A valid integer is required.']}}),
+            b'{"participant_ids":{"0":["A valid integer is required."]}}'
+        )
+
+    def test_render_escapes_line_separators(self):
+        """Test that U+2028/U+2029 are escaped like JSONRenderer does"""
+        self.assertEqual(
+            ORJSONRenderer().render({'content': 'a\u2028b\u2029c'}),
+            b'{"content":"a\\u2028b\\u2029c"}'
+        )
+
+
+# =============================================================================
+# API TESTS (Integration Tests)
+# =============================================================================
+
+class ChatAPITest(APITestCase):
+    """Integration tests for Chat endpoints"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='testpass123'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def create_chat(self, message_count=0):
+        """Create a chat with the test user and message_count messages from them"""
+        chat = Chat.objects.create(name='Test Chat')
+        chat.participants.add(self.user)
+        for i in range(message_count):
+            Message.objects.create(chat=chat, sender=self.user, content=f'Message {i}')
+        return chat
+
+    def test_get_messages_without_paging_returns_list(self):
+        """Test that existing clients still get the whole history as a list"""
+        chat = self.create_chat(message_count=3)
+
+        response = self.client.get(f'/api/chats/{chat.id}/messages/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['content'] for m in response.json()], ['Message 0', 'Message 1', 'Message 2'])
+
+    def test_get_messages_pages(self):
+        """Test walking the history back a page at a time with next_cursor"""
+        chat = self.create_chat(message_count=5)
+
+        page = self.client.get(f'/api/chats/{chat.id}/messages/', {'limit': 2}).json()
+        self.assertEqual([m['content'] for m in page['results']], ['Message 3', 'Message 4'])
+
+        page = self.client.get(
+            f'/api/chats/{chat.id}/messages/',
+            {'limit': 2, 'before_id': page['next_cursor']}
+        ).json()
+        self.assertEqual([m['content'] for m in page['results']], ['Message 1', 'Message 2'])
+
+        page = self.client.get(
+            f'/api/chats/{chat.id}/messages/',
+            {'limit': 2, 'before_id': page['next_cursor']}
+        ).json()
+        self.assertEqual([m['content'] for m in page['results']], ['Message 0'])
+        self.assertIsNone(page['next_cursor'])
+
+    def test_get_messages_last_page_exactly_full(self):
+        """Test that a last page holding exactly limit messages has no next_cursor"""
+        chat = self.create_chat(message_count=2)
+
+        page = self.client.get(f'/api/chats/{chat.id}/messages/', {'limit': 2}).json()
+
+        self.assertEqual(len(page['results']), 2)
+        self.assertIsNone(page['next_cursor'])
+
+    def test_get_messages_invalid_paging(self):
+        """Test that before_id and limit are validated"""
+        chat = self.create_chat()
+
+        for params in ({'limit': 0}, {'limit': 201}, {'before_id': 'abc'}):
+            response = self.client.get(f'/api/chats/{chat.id}/messages/', params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_chat_with_participants(self):
+        """Test that the creator, participant ids and valid usernames are all added once"""
+        user2 = User.objects.create_user(username='user2', password='testpass123')
+        user3 = User.objects.create_user(username='user3', password='testpass123')
+
+        response = self.client.post('/api/chats/', {
+            'name': 'Group',
+            'participant_ids': [user2.id, self.user.id],
+            'participant_usernames': ['user3', 'missing', 'user2']
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        chat = Chat.objects.get(id=response.json()['id'])
+        self.assertEqual(
+            set(chat.participants.values_list('id', flat=True)),
+            {self.user.id, user2.id, user3.id}
+        )
+
+    def test_reassigned_sender_username_updated(self):
+        """Test that saving a message with a new sender copies the new sender's username"""
+        user2 = User.objects.create_user(username='user2', password='testpass123')
+        message = self.create_chat(message_count=1).messages.get()
+
+        message.sender = user2
+        message.save()
+
+        message.refresh_from_db()
+        self.assertEqual(message.sender_username, 'user2')
+    
+    def test_non_participant_gets_404(self):
+        """Test that chats and messages of other users' chats are not found"""
+        other = User.objects.create_user(username='other', password='testpass123')
+        chat = Chat.objects.create(name='Private')
+        chat.participants.add(other)
+        message = Message.objects.create(chat=chat, sender=other, content='Secret')
+
+        self.assertEqual(self.client.get('/api/chats/').json(), [])
+        self.assertEqual(self.client.get('/api/messages/').json(), [])
+        for url in (f'/api/chats/{chat.id}/', f'/api/chats/{chat.id}/messages/', f'/api/messages/{message.id}/'):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(f'/api/chats/{chat.id}/send_message/', {'content': 'Hi'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_current_user_refreshed_after_save(self):
+        """Test that the cached current user profile is dropped when the user is saved"""
+        cache.clear()
+        self.assertEqual(self.client.get('/api/me/').json()['email'], 'user1@example.com')
+
+        self.user.email = 'new@example.com'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        self.assertEqual(self.client.get('/api/me/').json()['email'], 'new@example.com')
+
+    def test_create_chat_with_invalid_participant_ids(self):
+        """Test that a bad list item is a 400 with the error keyed by its index"""
+        response = self.client.post(
+            '/api/chats/',
+            {'name': 'Test Chat', 'participant_ids': ['abc']},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('0', response.json()['participant_ids'])
+
+
+class AuthAPITest(APITestCase):
+    """Integration tests for registration and login"""
+
+    def setUp(self):
+        cache.clear()
+
+    def login(self, username, password):
+        return self.client.post('/api/login/', {'username': username, 'password': password}, format='json')
+
+    @patch.object(LoginRateThrottle, 'get_rate', return_value='2/minute')
+    def test_login_attempts_throttled(self, mock_get_rate):
+        """Test that attempts over the rate are refused without authenticating, whether or not the user exists"""
+        User.objects.create_user(username='user1', password='testpass123')
+
+        self.assertEqual(self.login('user1', 'wrongpass').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.login('missing', 'wrongpass').status_code, status.HTTP_401_UNAUTHORIZED)
+        with patch('chat.views.authenticate') as mock_authenticate:
+            for username in ('user1', 'missing'):
+                response = self.login(username, 'wrongpass')
+                self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        mock_authenticate.assert_not_called()
+
+    def test_login_after_registering_with_failed_credentials(self):
+        """Test that a failure before an account exists does not block its first login"""
+        self.assertEqual(self.login('newuser', 'testpass123').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.post('/api/register/', {
+            'username': 'newuser',
+            'password': 'testpass123',
+            'password_confirm': 'testpass123'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertEqual(self.login('newuser', 'testpass123').status_code, status.HTTP_200_OK)
+
+    def test_register_short_password(self):
+        """Test that passwords under 8 characters are rejected before the user is created"""
+        response = self.client.post('/api/register/', {
+            'username': 'newuser',
+            'password': 'short',
+            'password_confirm': 'short'
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('password', response.json())
+        self.assertFalse(User.objects.filter(username='newuser').exists())
+
+    def test_login_after_password_change(self):
+        """Test that a password rejected before a change is accepted once it is the new password"""
+        user = User.objects.create_user(username='user1', password='testpass123')
+        self.assertEqual(self.login('user1', 'newpass456').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        user.set_password('newpass456')
+        user.save()
+
+        self.assertEqual(self.login('user1', 'newpass456').status_code, status.HTTP_200_OK)
+
+
+# =============================================================================
+# WEBSOCKET TESTS (Integration Tests)
+# =============================================================================
+
+class ChatWebSocketTest(TestCase):
+    """Integration tests for the chat WebSocket consumer"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='testpass123'
+        )
+        cls.chat = Chat.objects.create(name='WebSocket Test Chat')
+        cls.chat.participants.add(cls.user)
+
+    def make_communicator(self, user=None, chat_id=None):
+        """Build a communicator for the test chat, authenticated as user (default: self.user)"""
+        chat_id = str(chat_id or self.chat.id)
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{chat_id}/')
+        communicator.scope['user'] = user or self.user
+        communicator.scope['url_route'] = {'kwargs': {'chat_id': chat_id}}
+        return communicator
+
+    async def test_websocket_message_has_int_chat_id(self):
+        """Test that a saved message is sent with the chat id as a number"""
+        communicator = self.make_communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'content': 'Hello'})
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'message')
+        self.assertEqual(response['message']['chat'], self.chat.id)
+        self.assertEqual(response['message']['sender'], {'id': self.user.id, 'username': 'user1'})
+
+        await communicator.disconnect()
+
+    async def test_websocket_batches_burst_of_messages(self):
+        """Test that a burst of messages is saved in one INSERT and delivered in order"""
+        communicator = self.make_communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        with patch.object(Message.objects, 'bulk_create', wraps=Message.objects.bulk_create) as mock_bulk_create:
+            for i in range(3):
+                await communicator.send_json_to({'content': f'Message {i}'})
+
+            frames = [await communicator.receive_json_from() for _ in range(3)]
+
+        self.assertEqual([frame['type'] for frame in frames], ['message'] * 3)
+        self.assertEqual([frame['message']['content'] for frame in frames], ['Message 0', 'Message 1', 'Message 2'])
+        mock_bulk_create.assert_called_once()
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 3)
+
+        await communicator.disconnect()
+
+    async def test_websocket_disconnect_saves_pending_messages(self):
+        """Test that messages still waiting in the batch are saved on disconnect"""
+        communicator = self.make_communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'content': 'Last words'})
+        await communicator.disconnect()
+
+        self.assertTrue(await Message.objects.filter(chat=self.chat, content='Last words').aexists())
+
+    async def test_websocket_rejects_non_numeric_chat_id(self):
+        """Test that a chat id that is not a number closes the connection"""
+        communicator = self.make_communicator(chat_id='abc')
+
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
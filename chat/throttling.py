@@ -0,0 +1,16 @@
+"""
+Rate limits for the chat API.
+"""
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class LoginRateThrottle(SimpleRateThrottle):
+    """
+    Limit login attempts per client address, so repeated guesses cannot keep the
+    password hasher busy. Every attempt counts the same whether or not the username
+    exists, so the limit does not reveal which accounts do.
+    """
+    scope = 'login'
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
@@ -1,14 +1,22 @@
-from rest_framework import viewsets, status, permissions
-from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework import viewsets, status, permissions, serializers
+from rest_framework.decorators import action, api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
 from django.contrib.auth import authenticate, login, logout
-from drf_spectacular.utils import extend_schema, extend_schema_view, OpenApiParameter, OpenApiResponse, OpenApiExample
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Prefetch
+from drf_spectacular.utils import (
+    extend_schema, extend_schema_view, inline_serializer, OpenApiParameter, OpenApiResponse, OpenApiExample,
+    PolymorphicProxySerializer
+)
 from drf_spectacular.types import OpenApiTypes
-from .models import Chat, Message
+from .cache import CURRENT_USER_CACHE_TIMEOUT, current_user_cache_key
+from .models import Chat, Message, User
 from .serializers import (
     UserRegistrationSerializer, UserSerializer, UserListSerializer,
-    ChatSerializer, MessageSerializer
+    ChatSerializer, MessageSerializer, MessageDetailSerializer, MessagePageSerializer,
+    serialize_messages
 )
+from .throttling import LoginRateThrottle
 
 
 @extend_schema(
@@ -64,6 +72,7 @@ def register_user(request):
     responses={
         200: UserSerializer,
         401: OpenApiResponse(description='Invalid credentials'),
+        429: OpenApiResponse(description='Too many login attempts'),
     },
     examples=[
         OpenApiExample(
@@ -78,6 +87,7 @@ def register_user(request):
 )
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
+@throttle_classes([LoginRateThrottle])
 def login_user(request):
     username = request.data.get('username')
     password = request.data.get('password')
@@ -125,7 +135,13 @@ def logout_user(request):
 )
 @api_view(['GET'])
 def current_user(request):
-    return Response(UserSerializer(request.user).data)
+    # Polled by clients; the profile is dropped from the cache whenever the user is saved
+    key = current_user_cache_key(request.user.pk)
+    data = cache.get(key)
+    if data is None:
+        data = UserSerializer(request.user).data
+        cache.set(key, data, CURRENT_USER_CACHE_TIMEOUT)
+    return Response(data)
 
 
 @extend_schema(
@@ -141,9 +157,9 @@ def current_user(request):
 def list_users(request):
     from django.contrib.auth import get_user_model
     User = get_user_model()
-    users = User.objects.all()
-    serializer = UserListSerializer(users, many=True)
-    return Response(serializer.data)
+    # Plain columns: read them as dicts instead of building and serializing model instances
+    users = User.objects.values(*UserListSerializer.Meta.fields)
+    return Response(list(users))
 
 
 
@@ -203,8 +219,20 @@ class ChatViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        # Only return chats where the user is a participant
-        return Chat.objects.filter(participants=self.request.user).distinct()
+        # Only return chats where the user is a participant; EXISTS instead of a join
+        # that needs DISTINCT to drop duplicate rows
+        queryset = Chat.objects.filter(Exists(Chat.participants.through.objects.filter(
+            chat=OuterRef('pk'),
+            user=self.request.user
+        )))
+        if self.action in ('list', 'retrieve'):
+            # Load the nested participants and messages in three queries instead of per chat
+            queryset = queryset.prefetch_related(
+                # Skip the wide user columns (password hash, permission flags) nobody renders
+                Prefetch('participants', queryset=User.objects.only(*UserSerializer.Meta.fields)),
+                'messages'
+            )
+        return queryset
 
     @extend_schema(
         tags=['Chats'],
@@ -213,7 +241,7 @@ class ChatViewSet(viewsets.ModelViewSet):
         request=MessageSerializer,
         responses={
             201: MessageSerializer,
-            403: OpenApiResponse(description='User is not a participant in this chat'),
+            404: OpenApiResponse(description='Chat not found or user is not a participant'),
         },
         examples=[
             OpenApiExample(
@@ -225,15 +253,9 @@ class ChatViewSet(viewsets.ModelViewSet):
     )
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
+        # get_queryset only holds the user's chats, so this is also the participant check
         chat = self.get_object()
         
-        # Check if user is a participant
-        if not chat.participants.filter(id=request.user.id).exists():
-            return Response(
-                {'error': 'You are not a participant in this chat'},
-                status=status.HTTP_403_FORBIDDEN
-            )
-        
         serializer = MessageSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save(sender=request.user, chat=chat)
@@ -243,26 +265,54 @@ class ChatViewSet(viewsets.ModelViewSet):
     @extend_schema(
         tags=['Chats'],
         summary='Get chat messages',
-        description='Retrieve all messages in a specific chat.',
+        description='Retrieve the messages in a specific chat. Without before_id or limit, all messages are returned as a list. With either, one page is returned as {results, next_cursor}, newest page first: pass next_cursor as before_id to get the page before it; next_cursor is null on the oldest page.',
+        parameters=[MessagePageSerializer],
         responses={
-            200: MessageSerializer(many=True),
-            403: OpenApiResponse(description='User is not a participant in this chat'),
+            200: PolymorphicProxySerializer(
+                component_name='ChatMessages',
+                serializers=[
+                    MessageSerializer(many=True),
+                    inline_serializer('MessagePage', fields={
+                        'results': MessageSerializer(many=True),
+                        'next_cursor': serializers.IntegerField(allow_null=True)
+                    })
+                ],
+                resource_type_field_name=None,
+                many=False
+            ),
+            400: OpenApiResponse(description='Invalid before_id or limit'),
+            404: OpenApiResponse(description='Chat not found or user is not a participant'),
         }
     )
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
+        # get_queryset only holds the user's chats, so this is also the participant check
         chat = self.get_object()
         
-        # Check if user is a participant
-        if not chat.participants.filter(id=request.user.id).exists():
-            return Response(
-                {'error': 'You are not a participant in this chat'},
-                status=status.HTTP_403_FORBIDDEN
-            )
+        # Without paging parameters, existing clients keep getting the whole history as a list
+        if 'before_id' not in request.query_params and 'limit' not in request.query_params:
+            return Response(serialize_messages(chat.messages.all()))
+        
+        params = MessagePageSerializer(data=request.query_params)
+        if not params.is_valid():
+            return Response(params.errors, status=status.HTTP_400_BAD_REQUEST)
+        limit = params.validated_data['limit']
+        
+        # Keyset pagination: walk back from before_id on the (chat, id) index
+        # instead of counting past an OFFSET
+        messages = chat.messages.order_by('-id')
+        if 'before_id' in params.validated_data:
+            messages = messages.filter(id__lt=params.validated_data['before_id'])
+        # One extra row tells whether an older page exists
+        page = list(messages[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
         
-        messages = chat.messages.all()
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        return Response({
+            # Oldest first within the page
+            'results': serialize_messages(reversed(page)),
+            'next_cursor': page[-1].id if has_more else None
+        })
 
 
 @extend_schema_view(
@@ -274,7 +324,8 @@ class ChatViewSet(viewsets.ModelViewSet):
     retrieve=extend_schema(
         tags=['Messages'],
         summary='Get message details',
-        description='Retrieve details of a specific message.',
+        description='Retrieve details of a specific message, including the sender\'s profile.',
+        responses={200: MessageDetailSerializer},
     ),
 )
 class MessageViewSet(viewsets.ReadOnlyModelViewSet):
@@ -284,4 +335,19 @@ class MessageViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         # Only return messages from chats where the user is a participant
-        return Message.objects.filter(chat__participants=self.request.user).distinct()
+        queryset = Message.objects.filter(Exists(Chat.participants.through.objects.filter(
+            chat=OuterRef('chat'),
+            user=self.request.user
+        )))
+        if self.action == 'retrieve':
+            queryset = queryset.select_related('sender').only(
+                'id', 'chat_id', 'sender_id', 'content', 'timestamp',
+                *(f'sender__{field}' for field in UserSerializer.Meta.fields)
+            )
+        return queryset
+
+    def get_serializer_class(self):
+        # Only a single message carries the sender's full profile
+        if self.action == 'retrieve':
+            return MessageDetailSerializer
+        return MessageSerializer
@@ -58,9 +58,7 @@ Messages are received as JSON objects with the following structure:
         "chat": 1,
         "sender": {
             "id": 1,
-            "username": "john_doe",
-            "email": "john@example.com",
-            "user_type": "student"
+            "username": "john_doe"
         },
         "content": "Hello, everyone!",
         "timestamp": "2025-10-14T08:30:00Z"
@@ -7,6 +7,14 @@ import sys
 def main():
     """Run administrative tasks."""
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
+
+    # Install uvloop before runserver creates the event loop; no other command serves requests.
+    # It has to happen here: Daphne creates its loop while django.setup() loads the apps,
+    # before the runserver command itself is imported
+    if sys.argv[1:2] == ['runserver']:
+        from myproject.eventloop import install_uvloop
+        install_uvloop()
+
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
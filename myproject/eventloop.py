@@ -0,0 +1,20 @@
+"""
+Event loop setup for the ASGI server.
+
+Daphne creates its event loop when daphne.server is imported, so uvloop is only
+installed from manage.py for runserver, before django.setup() imports it. The daphne
+CLI imports daphne.server before loading the application and keeps the default loop.
+"""
+import asyncio
+
+
+def install_uvloop():
+    """
+    Use uvloop for new asyncio event loops when it is installed.
+    Must run before the server creates its loop to take effect.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -0,0 +1,46 @@
+"""
+orjson-backed JSON renderer and parser for the REST API.
+"""
+import orjson
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    Render responses with orjson instead of the stdlib encoder.
+    Datetimes and types orjson does not know (Decimal, lazy strings) go through
+    DRF's encoder, and U+2028/U+2029 are escaped as JSONRenderer does.
+
+    Unlike JSONRenderer, NaN and infinite floats render as null instead of
+    raising, output is always UTF-8 (as with the default UNICODE_JSON) and the
+    browsable API is indented by two spaces.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        # Non-string keys: ListField and many=True errors are keyed by item index
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            # orjson only indents by two spaces
+            option |= orjson.OPT_INDENT_2
+        ret = orjson.dumps(data, default=self.encoder_class().default, option=option)
+
+        # Line/paragraph separators are valid JSON but not valid JavaScript
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class ORJSONParser(JSONParser):
+    """Parse JSON request bodies with orjson"""
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
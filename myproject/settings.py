@@ -195,15 +195,59 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'myproject.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'myproject.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_THROTTLE_RATES': {
+        'login': os.environ.get('LOGIN_THROTTLE_RATE', '10/minute'),
+    },
 }
 
+REDIS_URL = os.environ.get('REDIS_URL')
+
 # Channels configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
+# Use REDIS_URL if available so group messages reach sockets on every instance
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# OpenAI configuration
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo')
+# Context window of OPENAI_MODEL and the part of it kept free for the reply
+OPENAI_CONTEXT_TOKENS = int(os.environ.get('OPENAI_CONTEXT_TOKENS', '16385'))
+OPENAI_RESPONSE_TOKENS = int(os.environ.get('OPENAI_RESPONSE_TOKENS', '1024'))
+
+# Cache configuration
+# Use REDIS_URL if available so cached AI chat history is shared between workers.
+# It is required with more than one worker process: the per-process local memory cache
+# would also keep each worker's AI chat turn locks to itself
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
 
 # DRF Spectacular settings for API documentation
 SPECTACULAR_SETTINGS = {